@@ -0,0 +1,611 @@
+const multiclassRequirements = {
+    'Barbarian': { 'strength': 13 },
+    'Bard': { 'charisma': 13 },
+    'Cleric': { 'wisdom': 13 },
+    'Druid': { 'wisdom': 13 },
+    'Fighter': { 'strength': 13, 'dexterity': 13 },
+    'Monk': { 'dexterity': 13, 'wisdom': 13 },
+    'Paladin': { 'strength': 13, 'charisma': 13 },
+    'Ranger': { 'dexterity': 13, 'wisdom': 13 },
+    'Rogue': { 'dexterity': 13 },
+    'Sorcerer': { 'charisma': 13 },
+    'Warlock': { 'charisma': 13 },
+    'Wizard': { 'intelligence': 13 }
+};
+
+
+// All rules data (subclasses, spells, caster progression) is fetched once
+// from a versioned, long-cached URL and shared by every dropdown handler.
+let rulesPromise = null;
+
+function loadRules() {
+    if (!rulesPromise) {
+        rulesPromise = fetch(`/rules/${document.documentElement.dataset.rulesVersion}`).then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            return response.json();
+        });
+        // Allow a retry after a failed load
+        rulesPromise.catch(() => { rulesPromise = null; });
+    }
+    return rulesPromise;
+}
+
+async function getSubclassData(className) {
+    const rules = await loadRules();
+    return {
+        subclasses: rules.subclasses[className] || [],
+        level_required: rules.subclass_levels[className] || 0
+    };
+}
+
+function displaySubclassSelector(selectorId, selectId, subclasses) {
+    const subclassSelector = document.getElementById(selectorId);
+    const subclassSelect = document.getElementById(selectId);
+
+    if (!subclassSelect) {
+        console.error("Subclass select element not found.");
+        return;
+    }
+
+    // Clear existing options
+    subclassSelect.innerHTML = '<option value="">Select a subclass</option>';
+
+    // Populate with new options
+    subclasses.forEach(subclass => {
+        const option = document.createElement('option');
+        option.value = subclass;
+        option.textContent = subclass;
+        subclassSelect.appendChild(option);
+    });
+
+    // Make the subclass selector visible
+    subclassSelector.style.display = 'block';
+}
+
+function hideSubclassSelector(selectorId) {
+    const subclassSelector = document.getElementById(selectorId);
+    subclassSelector.style.display = 'none';
+}
+
+// Event listeners to track changes
+document.addEventListener('DOMContentLoaded', function () {
+    document.getElementById('class_level').addEventListener('change', handleClassLevelChange);
+    document.getElementById('character_class').addEventListener('change', handleClassLevelChange);
+});
+
+async function handleClassLevelChange() {
+    const className = document.getElementById('character_class').value;
+    const classLevel = parseInt(document.getElementById('class_level').value);
+
+    if (!className) {
+        hideSubclassSelector('subclass_selector');
+        return;
+    }
+
+    // Fetch the subclass information for the selected class
+    try {
+        const data = await getSubclassData(className);
+        const subclassLevel = data.level_required;
+
+        if (classLevel >= subclassLevel) {
+            displaySubclassSelector('subclass_selector', 'subclass', data.subclasses);
+        } else {
+            hideSubclassSelector('subclass_selector');
+        }
+    } catch (error) {
+        console.error("Error fetching subclass data:", error);
+    }
+}
+
+async function handleMulticlassLevelChange(multiclassId) {
+    const className = document.getElementById(`multiclass_${multiclassId}`).value;
+    const classLevel = parseInt(document.getElementById(`multiclass_level_${multiclassId}`).value);
+
+    if (!className) {
+        hideSubclassSelector(`subclass_selector_${multiclassId}`);
+        return;
+    }
+
+    try {
+        const data = await getSubclassData(className);
+        const subclassLevel = data.level_required;
+
+        if (classLevel >= subclassLevel) {
+            displaySubclassSelector(`subclass_selector_${multiclassId}`, `subclass_${multiclassId}`, data.subclasses);
+        } else {
+            hideSubclassSelector(`subclass_selector_${multiclassId}`);
+        }
+    } catch (error) {
+        console.error("Error fetching subclass data:", error);
+    }
+}
+
+function checkMulticlassRequirements(className) {
+    const requirements = multiclassRequirements[className];
+    if (!requirements) return true;
+
+    const stats = {
+        'strength': parseInt(document.getElementById('strength').value),
+        'dexterity': parseInt(document.getElementById('dexterity').value),
+        'constitution': parseInt(document.getElementById('constitution').value),
+        'intelligence': parseInt(document.getElementById('intelligence').value),
+        'wisdom': parseInt(document.getElementById('wisdom').value),
+        'charisma': parseInt(document.getElementById('charisma').value)
+    };
+
+    // Special case for Fighter which can use STR or DEX
+    if (className === 'Fighter') {
+        return stats.strength >= 13 || stats.dexterity >= 13;
+    }
+
+    // Check all requirements
+    return Object.entries(requirements).every(([stat, minValue]) =>
+        stats[stat] >= minValue
+    );
+}
+
+async function calculateTotal() {
+    try {
+        const stats = ['strength', 'dexterity', 'constitution',
+            'intelligence', 'wisdom', 'charisma'];
+        let scores = [];
+
+        // Collect scores
+        for (const stat of stats) {
+            const value = parseInt(document.getElementById(stat).value);
+            scores.push(value);
+        }
+
+        const response = await fetch('/validate_points', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ scores: scores })
+        });
+
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+
+        const result = await response.json();
+        const totalElement = document.getElementById('point-total');
+        const total = result.total || 0;
+
+        // Update total display
+        totalElement.textContent = `Points Spent: ${total}/35`;
+
+        // Visual feedback
+        if (total > 35) {
+            totalElement.style.color = 'red';
+            document.getElementById('submit-button').disabled = true;
+        } else {
+            totalElement.style.color = 'green';
+            document.getElementById('submit-button').disabled = false;
+        }
+
+        // Update individual costs
+        if (result.individual_costs) {
+            stats.forEach((stat, index) => {
+                const costElement = document.getElementById(`${stat}-cost`);
+                if (costElement) {
+                    costElement.textContent = `Cost: ${result.individual_costs[index]} points`;
+                    costElement.style.color = result.total > 35 ? 'red' : '#666';
+                }
+            });
+        }
+
+    } catch (error) {
+        console.error('Error:', error);
+    }
+}
+
+
+// Initial calculation
+document.addEventListener('DOMContentLoaded', calculateTotal);
+
+let multiclassCount = 0;
+
+function addMulticlass() {
+    multiclassCount++;
+    const container = document.getElementById('class-container');
+    // Same choices as the primary class selector, which the server rendered
+    const classOptions = document.getElementById('character_class').innerHTML;
+    let levelOptions = '';
+    for (let level = 1; level <= 20; level++) {
+        levelOptions += `<option value="${level}">Level ${level}</option>`;
+    }
+    const newClassField = document.createElement('div');
+    newClassField.className = 'class-field';
+    newClassField.innerHTML = `
+    <label for="multiclass_${multiclassCount}">Additional Class:</label>
+    <select name="multiclass_${multiclassCount}" 
+            id="multiclass_${multiclassCount}" 
+            onchange="handleMulticlassLevelChange(${multiclassCount})" 
+            required>
+        ${classOptions}
+    </select>
+    <select name="multiclass_level_${multiclassCount}" 
+            id="multiclass_level_${multiclassCount}" 
+            onchange="handleMulticlassLevelChange(${multiclassCount})" 
+            required>
+        ${levelOptions}
+    </select>
+    <div id="subclass_selector_${multiclassCount}" style="display: none;">
+        <label for="subclass_${multiclassCount}">Subclass:</label>
+        <select id="subclass_${multiclassCount}" name="subclass_${multiclassCount}">
+            <option value="">Select a subclass</option>
+        </select>
+    </div>
+    <button type="button" onclick="removeMulticlass(this)" class="remove-class-button">Remove</button>
+    <span class="error-message" id="error_${multiclassCount}"></span>
+    `;
+    container.appendChild(newClassField);
+}
+
+let selectedClasses = [''];  // Empty string for initial unselected primary class
+
+function validateMulticlass(selectElement) {
+    const className = selectElement.value;
+    const errorId = 'error_' + selectElement.id.split('_')[1];
+    const errorElement = document.getElementById(errorId);
+
+    // Check for duplicate class
+    if (selectedClasses.includes(className)) {
+        errorElement.textContent = `You are already using the ${className} class`;
+        selectElement.value = '';
+        return;
+    }
+
+    // Update selected classes array
+    const index = parseInt(selectElement.id.split('_')[1]) || 0;
+    selectedClasses[index] = className;
+
+    // Check multiclass requirements
+    if (!checkMulticlassRequirements(className)) {
+        errorElement.textContent = `You need the following stats to multiclass into ${className}: 
+            ${Object.entries(multiclassRequirements[className])
+                .map(([stat, value]) => `${stat.charAt(0).toUpperCase() + stat.slice(1)} ${value}`)
+                .join(', ')}`;
+        errorElement.style.color = 'red';
+        selectElement.value = '';
+        selectedClasses[index] = '';
+    } else {
+        errorElement.textContent = '';
+    }
+}
+
+function removeMulticlass(button) {
+    const selectElement = button.parentElement.querySelector('select');
+    const index = parseInt(selectElement.id.split('_')[1]);
+    selectedClasses[index] = '';  // Clear the class from tracking
+    button.parentElement.remove();
+    updateSpellSlots();
+}
+
+// Update primary class selector to use validation
+document.addEventListener('DOMContentLoaded', function () {
+    const primaryClass = document.getElementById('character_class');
+    primaryClass.addEventListener('change', function () {
+        validateMulticlass(this);
+    });
+});
+
+function collectClassData() {
+    let classes = [];
+
+    // Get primary class data
+    const primaryClass = document.getElementById('character_class');
+    const primaryLevel = document.getElementById('class_level');
+    const primarySubclass = document.getElementById('subclass');
+
+    if (primaryClass && primaryLevel && primaryClass.value) {
+        const classEntry = {
+            class: primaryClass.value,
+            level: primaryLevel.value,
+        };
+        if (primarySubclass && primarySubclass.value) {
+            classEntry.subclass = primarySubclass.value;
+        }
+        classes.push(classEntry);
+    }
+
+    // Get multiclass data
+    const multiclassFields = document.querySelectorAll('.class-field');
+
+    multiclassFields.forEach((field, index) => {
+        if (index === 0) return; // Skip primary class (already added)
+
+        const classSelect = field.querySelector('select[id^="multiclass_"]');
+        const levelSelect = field.querySelector('select[id^="multiclass_level_"]');
+        const subclassSelect = field.querySelector('select[id^="subclass_"]');
+
+        if (classSelect && levelSelect && classSelect.value) {
+            const classEntry = {
+                class: classSelect.value,
+                level: levelSelect.value,
+            };
+            if (subclassSelect && subclassSelect.value) {
+                classEntry.subclass = subclassSelect.value;
+            }
+            classes.push(classEntry);
+        }
+    });
+
+    return classes;
+}
+
+function collectSpellData() {
+    const selectedSpells = [];
+    const spellItems = document.querySelectorAll('#selected-spells li');
+    spellItems.forEach(item => {
+        // Get only the spell text, excluding the Remove button text
+        const spellText = item.childNodes[0].nodeValue.trim();
+        if (spellText) {
+            selectedSpells.push(spellText);
+        }
+    });
+    console.log('Collected spells:', selectedSpells);
+    return selectedSpells;
+}
+
+function handleFormSubmit(event) {
+    event.preventDefault();
+    const classData = collectClassData();
+    const spellData = collectSpellData();
+    console.log('Spell data before JSON:', spellData);
+
+    const formData = {
+        character_name: document.getElementById('character_name').value,
+        class_data: classData,
+        spells: spellData,
+        strength: document.getElementById('strength').value,
+        dexterity: document.getElementById('dexterity').value,
+        constitution: document.getElementById('constitution').value,
+        intelligence: document.getElementById('intelligence').value,
+        wisdom: document.getElementById('wisdom').value,
+        charisma: document.getElementById('charisma').value
+    };
+
+    // Double clicks and retries are deduplicated by the server, but
+    // there is no point sending them
+    const submitButton = document.getElementById('submit-button');
+    submitButton.disabled = true;
+
+    fetch('/?async=1', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify(formData)
+    }).then(response => response.json())
+      .then(data => {
+          if (data.sheet_id) {
+              // Same character was already created
+              return data;
+          }
+          if (!data.job_id) {
+              throw new Error(data.error || 'Character could not be queued');
+          }
+          return waitForJob(data.job_id);
+      })
+      .then(job => {
+          console.log('Success:', job);
+          // Redirect to result page with data
+          const unplaced = (job.unplaced_spells || [])
+              .map(spell => `&unplaced_spell=${encodeURIComponent(spell)}`).join('');
+          window.location.href = `/result?character_name=${encodeURIComponent(job.character_name)}&sheet_id=${job.sheet_id}${unplaced}`;
+      })
+      .catch((error) => {
+          console.error('Error:', error);
+          showProgress(`Something went wrong: ${error.message}`);
+          submitButton.disabled = false;
+      });
+}
+
+const PROGRESS_MESSAGES = {
+    queued: 'Waiting for a free slot...',
+    running: 'Copying the character sheet...',
+    copied: 'Reading the sheet layout...',
+    metadata: 'Writing abilities and spells...',
+    written: 'Finishing up...',
+    retrying: 'Google Sheets is not responding, your character will be created as soon as it is back...',
+    done: 'Done!'
+};
+
+function showProgress(message) {
+    document.getElementById('progress-message').textContent = message;
+}
+
+// Follow a background character job's progress stream until it has
+// finished, falling back to polling where streams are unavailable
+function waitForJob(jobId) {
+    if (!window.EventSource) {
+        return pollJob(jobId);
+    }
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(`/jobs/${jobId}/events`);
+        let finished = false;
+        Object.keys(PROGRESS_MESSAGES).forEach(stage => {
+            source.addEventListener(stage, () => showProgress(PROGRESS_MESSAGES[stage]));
+        });
+        source.addEventListener('done', event => {
+            finished = true;
+            source.close();
+            resolve(JSON.parse(event.data));
+        });
+        source.addEventListener('failed', event => {
+            finished = true;
+            source.close();
+            reject(new Error(JSON.parse(event.data).error));
+        });
+        // The server ends the stream while a retry is pending, which may be hours away
+        source.addEventListener('retrying', () => {
+            finished = true;
+            source.close();
+            pollJob(jobId).then(resolve, reject);
+        });
+        source.onerror = () => {
+            // The browser reconnects by itself unless the stream is gone for good
+            if (!finished && source.readyState === EventSource.CLOSED) {
+                pollJob(jobId).then(resolve, reject);
+            }
+        };
+    });
+}
+
+// Poll a background character job until it has finished, slowly while
+// it waits for a retry
+async function pollJob(jobId) {
+    while (true) {
+        const response = await fetch(`/jobs/${jobId}`);
+        if (!response.ok) {
+            throw new Error(`HTTP error! Status: ${response.status}`);
+        }
+        const job = await response.json();
+        if (job.status === 'done') {
+            return job;
+        }
+        if (job.status === 'failed') {
+            throw new Error(job.error);
+        }
+        if (PROGRESS_MESSAGES[job.stage]) {
+            showProgress(PROGRESS_MESSAGES[job.stage]);
+        }
+        const delay = job.status === 'retrying' ? 15000 : 1000;
+        await new Promise(resolve => setTimeout(resolve, delay));
+    }
+}
+
+async function handleClassChange() {
+    const className = document.getElementById('character_class').value;
+    const classLevel = parseInt(document.getElementById('class_level').value);
+
+    if (!className) {
+        hideSubclassSelector('subclass_selector');
+        hideSpellSelector('spell_selector');
+        return;
+    }
+
+    // Fetch the subclass information for the selected class
+    try {
+        const data = await getSubclassData(className);
+        const subclassLevel = data.level_required;
+
+        if (classLevel >= subclassLevel) {
+            displaySubclassSelector('subclass_selector', 'subclass', data.subclasses);
+        } else {
+            hideSubclassSelector('subclass_selector');
+        }
+    } catch (error) {
+        console.error("Error fetching subclass data:", error);
+    }
+
+    // Fetch the spell information for the selected class
+    try {
+        const rules = await loadRules();
+        displaySpellSelector('spell_selector', 'spells', rules.spells[className] || {});
+    } catch (error) {
+        console.error("Error fetching spell data:", error);
+    }
+}
+
+function displaySpellSelector(selectorId, selectId, spells) {
+    const spellSelector = document.getElementById(selectorId);
+    const spellSelect = document.getElementById(selectId);
+
+    if (!spellSelect) {
+        console.error("Spell select element not found.");
+        return;
+    }
+
+    // Clear existing options
+    spellSelect.innerHTML = '<option value="">Select a spell</option>';
+
+    // Populate with new options
+    for (const [level, spellList] of Object.entries(spells)) {
+        spellList.forEach(spell => {
+            const option = document.createElement('option');
+            option.value = `${level}: ${spell}`;
+            option.textContent = `Level ${level}: ${spell}`;
+            spellSelect.appendChild(option);
+        });
+    }
+
+    // Make the spell selector visible
+    spellSelector.style.display = 'block';
+}
+
+function hideSpellSelector(selectorId) {
+    const spellSelector = document.getElementById(selectorId);
+    spellSelector.style.display = 'none';
+}
+
+function addSelectedSpell() {
+    const spellSelect = document.getElementById('spells');
+    const selectedSpell = spellSelect.value;
+
+    if (selectedSpell) {
+        const selectedSpellsContainer = document.getElementById('selected-spells');
+        const spellItem = document.createElement('li');
+
+        // Create a text node for the spell
+        const spellText = document.createTextNode(selectedSpell);
+        spellItem.appendChild(spellText);
+
+        // Add a remove button for each spell
+        const removeButton = document.createElement('button');
+        removeButton.textContent = 'Remove';
+        removeButton.className = 'remove-spell-button';
+        removeButton.onclick = function() {
+            selectedSpellsContainer.removeChild(spellItem);
+        };
+
+        spellItem.appendChild(removeButton);
+        selectedSpellsContainer.appendChild(spellItem);
+        console.log('Added spell:', selectedSpell);
+    }
+}
+
+let spellSlotsRequest = null;
+
+// Show the spell slots of the classes picked so far; only the latest answer is shown
+async function updateSpellSlots() {
+    const slotsElement = document.getElementById('spell-slots');
+    if (spellSlotsRequest) {
+        spellSlotsRequest.abort();
+    }
+    spellSlotsRequest = new AbortController();
+    try {
+        const response = await fetch('/spell_slots', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ class_data: collectClassData() }),
+            signal: spellSlotsRequest.signal
+        });
+        const data = await response.json();
+        if (!response.ok) {
+            slotsElement.textContent = '';
+            return;
+        }
+        const parts = Object.entries(data.slots).map(([level, count]) => `${level}: ${count}`);
+        if (data.pact_magic) {
+            parts.push(`Pact: ${data.pact_magic.slots} at level ${data.pact_magic.slot_level}`);
+        }
+        slotsElement.textContent = parts.length ? `Spell Slots: ${parts.join(', ')}` : '';
+    } catch (error) {
+        if (error.name !== 'AbortError') {
+            console.error('Error fetching spell slots:', error);
+        }
+    }
+}
+
+document.addEventListener('DOMContentLoaded', function () {
+    // Class, level and subclass changes of every class row bubble up to the container
+    document.getElementById('class-container').addEventListener('change', updateSpellSlots);
+    document.getElementById('character_class').addEventListener('change', handleClassChange);
+    document.getElementById('class_level').addEventListener('change', handleClassChange);
+    document.getElementById('spells').addEventListener('change', addSelectedSpell);
+});
@@ -0,0 +1,281 @@
+"""In-process stand-in for the Google Drive and Sheets endpoints site.py uses.
+
+FakeGoogleApi keeps spreadsheets in memory and answers the requests that
+googleapiclient sends, so the whole character pipeline can run without
+network access or credentials:
+
+    fake = FakeGoogleApi(latency=0.05, quota_error_rate=0.01)
+    site.google_http_factory = fake.http
+    site.async_transport_factory = fake.async_transport
+
+Supported calls are Drive files.copy, files.get, files.update, files.export
+and multipart files.create, and Sheets spreadsheets.get, values.update and
+values.batchUpdate. Exporting and uploading .xlsx workbooks needs openpyxl.
+Every call can be slowed down, rejected with a 429 quota error or failed
+with a 500.
+"""
+import asyncio
+import email
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from urllib.parse import unquote, urlsplit
+
+import httplib2
+
+DRIVE_FILE = re.compile(r'^/drive/v3/files/(?P<file_id>[^/]+)(?P<action>/copy|/export)?$')
+DRIVE_UPLOAD = '/upload/drive/v3/files'
+SPREADSHEET = re.compile(r'^/v4/spreadsheets/(?P<spreadsheet_id>[^/]+?)(?P<rest>/values.*)?$')
+
+
+class FakeGoogleApi:
+    """Shared state and failure settings for every fake connection."""
+
+    def __init__(self, latency=0.0, latency_jitter=0.0, quota_error_rate=0.0, failure_rate=0.0,
+                 quota_per_minute=None, template_id='1Mx-R-sDVDcV-tEMXz0KrMlKij2BejMXD9AYxp3O6OX4',
+                 template_tabs=('Character Sheet',), seed=None):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.quota_error_rate = quota_error_rate
+        self.failure_rate = failure_rate
+        self.quota_per_minute = quota_per_minute
+        self.template_id = template_id
+        self.calls = Counter()
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._recent_calls = deque()
+        self.files = {}
+        self.add_spreadsheet(template_id, 'Character Sheet Template', template_tabs)
+
+    def add_spreadsheet(self, spreadsheet_id, name, tabs):
+        self.files[spreadsheet_id] = {
+            'name': name,
+            'version': 1,
+            'sheets': [
+                {'properties': {'sheetId': index, 'title': title, 'index': index,
+                                'gridProperties': {'rowCount': 1000, 'columnCount': 60}}}
+                for index, title in enumerate(tabs)
+            ],
+            'values': {},
+        }
+
+    def http(self):
+        """Return a connection object to hand to googleapiclient's build()."""
+        return FakeHttp(self)
+
+    def async_transport(self):
+        """Return a transport to hand to site.AsyncGoogleClient."""
+        return FakeAsyncTransport(self)
+
+    @property
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+            self.bytes_received = 0
+
+    def handle(self, uri, method, body, headers=None):
+        """Answer one request after the simulated latency, returning (status, payload).
+
+        payload is a JSON-serializable object, or bytes for an export.
+        """
+        delay = self.next_delay()
+        if delay:
+            time.sleep(delay)
+        return self.respond(uri, method, body, headers)
+
+    def next_delay(self):
+        return self.latency + self._random.uniform(0, self.latency_jitter)
+
+    def respond(self, uri, method, body, headers=None):
+        """Answer one request straight away, returning (status, payload)."""
+        try:
+            return self._respond(urlsplit(uri), method, body, headers or {})
+        except InvalidRange as err:
+            return 400, _error(400, f'Unable to parse range: {err}', 'INVALID_ARGUMENT', 'badRequest')
+
+    def _respond(self, parts, method, body, headers):
+        with self.lock:
+            self.bytes_received += len(body or b'')
+            if self._over_quota() or self._random.random() < self.quota_error_rate:
+                self.calls['quota_error'] += 1
+                return 429, _error(429, 'Quota exceeded for quota metric', 'RESOURCE_EXHAUSTED', 'rateLimitExceeded')
+            if self._random.random() < self.failure_rate:
+                self.calls['injected_failure'] += 1
+                return 500, _error(500, 'Internal error encountered.', 'INTERNAL', 'backendError')
+
+            if parts.netloc == 'www.googleapis.com' and parts.path == DRIVE_UPLOAD and method == 'POST':
+                return self._upload(body, headers)
+            if parts.netloc == 'www.googleapis.com':
+                return self._drive(parts.path, method, body)
+            if parts.netloc == 'sheets.googleapis.com':
+                return self._sheets(parts.path, method, body)
+            return 404, _error(404, f'Unknown host {parts.netloc}', 'NOT_FOUND', 'notFound')
+
+    def _over_quota(self):
+        if self.quota_per_minute is None:
+            return False
+        now = time.monotonic()
+        while self._recent_calls and now - self._recent_calls[0] > 60:
+            self._recent_calls.popleft()
+        if len(self._recent_calls) >= self.quota_per_minute:
+            return True
+        self._recent_calls.append(now)
+        return False
+
+    def _drive(self, path, method, body):
+        match = DRIVE_FILE.match(path)
+        if not match or match['file_id'] not in self.files:
+            return 404, _error(404, f'File not found: {path}', 'NOT_FOUND', 'notFound')
+        source = self.files[match['file_id']]
+        request_body = json.loads(body) if body else {}
+
+        if match['action'] == '/copy' and method == 'POST':
+            self.calls['drive.files.copy'] += 1
+            new_id = uuid.uuid4().hex
+            self.files[new_id] = {
+                'name': request_body.get('name', f"Copy of {source['name']}"),
+                'version': 1,
+                'sheets': json.loads(json.dumps(source['sheets'])),
+                'values': dict(source['values']),
+            }
+            return 200, {'kind': 'drive#file', 'id': new_id, 'name': self.files[new_id]['name'],
+                         'mimeType': 'application/vnd.google-apps.spreadsheet'}
+        if match['action'] == '/export' and method == 'GET':
+            self.calls['drive.files.export'] += 1
+            return 200, self._export(source)
+        if not match['action'] and method == 'GET':
+            self.calls['drive.files.get'] += 1
+            return 200, {'kind': 'drive#file', 'id': match['file_id'], 'name': source['name'],
+                         'version': str(source['version'])}
+        if not match['action'] and method == 'PATCH':
+            self.calls['drive.files.update'] += 1
+            source.update({key: value for key, value in request_body.items() if key in ('name', 'trashed')})
+            source['version'] += 1
+            return 200, {'kind': 'drive#file', 'id': match['file_id'], 'name': source['name']}
+        return 405, _error(405, f'{method} not supported on {path}', 'INVALID_ARGUMENT', 'badRequest')
+
+    @staticmethod
+    def _export(source):
+        """Return a spreadsheet as .xlsx bytes with its tabs and written values."""
+        import openpyxl
+        workbook = openpyxl.Workbook()
+        workbook.remove(workbook.active)
+        for tab in source['sheets']:
+            workbook.create_sheet(tab['properties']['title'])
+        for cell_range, values in source['values'].items():
+            title, _, cells = cell_range.rpartition('!')
+            workbook[title.strip("'")][cells.split(':')[0]] = values[0][0]
+        output = io.BytesIO()
+        workbook.save(output)
+        return output.getvalue()
+
+    def _upload(self, body, headers):
+        """Drive files.create with uploadType=multipart, converting an .xlsx upload to a spreadsheet."""
+        import openpyxl
+        self.calls['drive.files.create'] += 1
+        content_type = {key.lower(): value for key, value in headers.items()}.get('content-type', '')
+        message = email.message_from_bytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        metadata_part, media_part = message.get_payload()
+        metadata = json.loads(metadata_part.get_payload(decode=True))
+        workbook = openpyxl.load_workbook(io.BytesIO(media_part.get_payload(decode=True)))
+
+        new_id = uuid.uuid4().hex
+        self.add_spreadsheet(new_id, metadata.get('name', 'Untitled spreadsheet'), workbook.sheetnames)
+        self.files[new_id]['values'] = {
+            f'{worksheet.title}!{cell.coordinate}': [[cell.value]]
+            for worksheet in workbook.worksheets
+            for row in worksheet.iter_rows()
+            for cell in row
+            if cell.value is not None
+        }
+        return 200, {'kind': 'drive#file', 'id': new_id, 'name': self.files[new_id]['name'],
+                     'mimeType': 'application/vnd.google-apps.spreadsheet'}
+
+    def _sheets(self, path, method, body):
+        match = SPREADSHEET.match(path)
+        if not match or match['spreadsheet_id'] not in self.files:
+            return 404, _error(404, 'Requested entity was not found.', 'NOT_FOUND', 'notFound')
+        spreadsheet_id = match['spreadsheet_id']
+        spreadsheet = self.files[spreadsheet_id]
+        rest = match['rest'] or ''
+        request_body = json.loads(body) if body else {}
+
+        if not rest and method == 'GET':
+            self.calls['sheets.spreadsheets.get'] += 1
+            return 200, {'spreadsheetId': spreadsheet_id,
+                         'properties': {'title': spreadsheet['name']},
+                         'sheets': spreadsheet['sheets']}
+        if rest == '/values:batchUpdate' and method == 'POST':
+            self.calls['sheets.values.batchUpdate'] += 1
+            for value_range in request_body.get('data', []):
+                self._check_range(spreadsheet, value_range['range'])
+                spreadsheet['values'][value_range['range']] = value_range['values']
+            spreadsheet['version'] += 1
+            return 200, {'spreadsheetId': spreadsheet_id, 'totalUpdatedCells': len(request_body.get('data', []))}
+        if rest.startswith('/values/') and method == 'PUT':
+            self.calls['sheets.values.update'] += 1
+            cell_range = unquote(rest[len('/values/'):])
+            self._check_range(spreadsheet, cell_range)
+            spreadsheet['values'][cell_range] = request_body.get('values')
+            spreadsheet['version'] += 1
+            return 200, {'spreadsheetId': spreadsheet_id, 'updatedRange': cell_range, 'updatedCells': 1}
+        return 405, _error(405, f'{method} not supported on {path}', 'INVALID_ARGUMENT', 'badRequest')
+
+    @staticmethod
+    def _check_range(spreadsheet, cell_range):
+        title, _, cells = cell_range.rpartition('!')
+        if not cells or title.strip("'") not in {tab['properties']['title'] for tab in spreadsheet['sheets']}:
+            raise InvalidRange(cell_range)
+
+
+class InvalidRange(Exception):
+    pass
+
+
+class FakeHttp:
+    """Minimal httplib2.Http replacement that routes requests to a FakeGoogleApi."""
+
+    def __init__(self, api):
+        self.api = api
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=None, connection_type=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        status, payload = self.api.handle(uri, method, body, headers)
+        if isinstance(payload, bytes):
+            content, content_type = payload, 'application/octet-stream'
+        else:
+            content, content_type = json.dumps(payload).encode('utf-8'), 'application/json; charset=UTF-8'
+        response = httplib2.Response({'status': status, 'content-type': content_type})
+        return response, content
+
+
+class FakeAsyncTransport:
+    """Async transport for site.AsyncGoogleClient that routes requests to a FakeGoogleApi."""
+
+    errors = ()
+
+    def __init__(self, api):
+        self.api = api
+
+    async def request(self, method, url, params=None, data=None, headers=None):
+        delay = self.api.next_delay()
+        if delay:
+            await asyncio.sleep(delay)
+        status, payload = self.api.respond(url, method, data, headers)
+        return status, {'content-type': 'application/json; charset=UTF-8'}, json.dumps(payload).encode('utf-8')
+
+
+def _error(code, message, status, reason):
+    return {'error': {'code': code, 'message': message, 'status': status,
+                      'errors': [{'message': message, 'domain': 'global', 'reason': reason}]}}
@@ -0,0 +1,195 @@
+"""End-to-end throughput benchmark against the in-process fake Google API.
+
+Drives POST /, /validate_points and /get_combined_spells through the Flask
+test client at each requested concurrency level and reports latency
+percentiles, requests per second and, for character creation, Google API
+calls per character. Results are written to benchmarks/results/<label>.json
+so runs from different versions can be compared:
+
+    python benchmarks/run.py --label before
+    python benchmarks/run.py --label after --compare benchmarks/results/before.json
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_google import FakeGoogleApi
+from site_loader import REPO_ROOT, load_site
+
+RESULTS_DIR = os.path.join(REPO_ROOT, 'benchmarks', 'results')
+
+CHARACTER = {
+    'character_name': 'Benchmark Hero',
+    'class_data': [{'class': 'Wizard', 'level': '5', 'subclass': 'School of Evocation'},
+                   {'class': 'Cleric', 'level': '2'}],
+    'spells': ['1: Magic Missile', '1: Shield', '1: Cure Wounds', '2: Misty Step', '2: Scorching Ray'],
+    'strength': '8', 'dexterity': '14', 'constitution': '14',
+    'intelligence': '15', 'wisdom': '12', 'charisma': '8',
+}
+
+SCENARIOS = {
+    # A fresh key per request, or every request after the first would reuse its sheet
+    'create_character': lambda client: client.post('/', json=CHARACTER,
+                                                   headers={'Idempotency-Key': uuid.uuid4().hex}),
+    'validate_points': lambda client: client.post('/validate_points', json={'scores': [15, 14, 13, 12, 10, 8]}),
+    'combined_spells': lambda client: client.post('/get_combined_spells',
+                                                  json={'class_names': ['Wizard', 'Cleric', 'Bard']}),
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_scenario(app, scenario, concurrency, requests, warmup, on_measure_start=None):
+    """Send `requests` calls using `concurrency` threads; return latencies and error count.
+
+    `warmup` unrecorded calls go first so every worker thread has built its
+    API clients before measuring starts.
+    """
+    send = SCENARIOS[scenario]
+    clients = threading.local()
+    errors = []
+
+    def one_request(_):
+        client = getattr(clients, 'client', None)
+        if client is None:
+            client = clients.client = app.test_client()
+        started = time.perf_counter()
+        response = send(client)
+        elapsed = time.perf_counter() - started
+        if response.status_code >= 400 or (scenario == 'create_character' and not response.json.get('sheet_id')):
+            errors.append(response.status_code)
+        return elapsed
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one_request, range(warmup)))
+        errors.clear()
+        if on_measure_start is not None:
+            on_measure_start()
+        started = time.perf_counter()
+        latencies = sorted(pool.map(one_request, range(requests)))
+        wall_time = time.perf_counter() - started
+    return latencies, wall_time, len(errors)
+
+
+def summarize(latencies, wall_time, errors):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'requests_per_second': len(latencies) / wall_time,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Print the change in p50/p95 latency and throughput against a previous run."""
+    print(f"\nCompared with {baseline.get('label')} ({baseline.get('revision')}):")
+    for key, current in results['runs'].items():
+        previous = baseline['runs'].get(key)
+        if previous is None:
+            continue
+        changes = []
+        for metric in ('p50_ms', 'p95_ms', 'requests_per_second', 'api_calls_per_character'):
+            if current.get(metric) is not None and previous.get(metric):
+                change = (current[metric] - previous[metric]) / previous[metric] * 100
+                changes.append(f"{metric} {change:+.1f}%")
+        print(f"  {key:<28} " + ', '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--label', default=None, help='name of the results file (default: git revision)')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario and concurrency level')
+    parser.add_argument('--warmup', type=int, default=None,
+                        help='unrecorded requests before each run (default: twice the concurrency)')
+    parser.add_argument('--latency', type=float, default=0.05, help='fake Google API latency in seconds')
+    parser.add_argument('--latency-jitter', type=float, default=0.02)
+    parser.add_argument('--quota-error-rate', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--real-quotas', action='store_true',
+                        help="keep the app's Google API rate limits instead of lifting them")
+    parser.add_argument('--async-google', action='store_true',
+                        help='create characters as coroutines on the asyncio Google transport')
+    parser.add_argument('--local-render', action='store_true',
+                        help='fill characters into a local template export and upload each in one call')
+    parser.add_argument('--compare', help='previous results file to compare against')
+    args = parser.parse_args()
+
+    site = load_site(lift_quotas=not args.real_quotas)
+    site.GOOGLE_API_BACKOFF_BASE = 0.05
+    # Per-character info logs would otherwise dominate the output
+    site.logger.setLevel(logging.WARNING)
+    fake = FakeGoogleApi(latency=args.latency, latency_jitter=args.latency_jitter,
+                         quota_error_rate=args.quota_error_rate, failure_rate=args.failure_rate,
+                         template_id=site.TEMPLATE_SPREADSHEET_ID, seed=1)
+    site.google_http_factory = fake.http
+    site.async_transport_factory = fake.async_transport
+    if args.async_google:
+        site.ASYNC_GOOGLE = True
+        # Every benchmark request may be in flight at once
+        site.JOB_QUEUE_LIMIT = max(site.JOB_QUEUE_LIMIT, max(args.concurrency))
+    if args.local_render:
+        site.LOCAL_RENDER = True
+        site.TEMPLATE_EXPORT_DIR = tempfile.mkdtemp(prefix='gsheet-bench-exports-')
+
+    revision = git_revision()
+    results = {
+        'label': args.label or revision,
+        'revision': revision,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'settings': vars(args),
+        'runs': {},
+    }
+    for scenario in args.scenarios:
+        for concurrency in args.concurrency:
+            warmup = args.warmup if args.warmup is not None else 2 * concurrency
+            latencies, wall_time, errors = run_scenario(
+                site.app, scenario, concurrency, args.requests, warmup,
+                on_measure_start=fake.reset_counters)
+            summary = summarize(latencies, wall_time, errors)
+            if scenario == 'create_character':
+                created = summary['requests'] - errors
+                summary['api_calls_per_character'] = fake.total_calls / created if created else None
+                summary['api_calls'] = dict(fake.calls)
+            results['runs'][f'{scenario}@{concurrency}'] = summary
+            print(f"{scenario:<18} c={concurrency:<4} p50={summary['p50_ms']:8.2f}ms "
+                  f"p95={summary['p95_ms']:8.2f}ms p99={summary['p99_ms']:8.2f}ms "
+                  f"rps={summary['requests_per_second']:9.1f} errors={errors}"
+                  + (f" api/char={summary['api_calls_per_character']:.2f}"
+                     if summary.get('api_calls_per_character') is not None else ''))
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{results['label']}.json")
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"\nResults written to {os.path.relpath(path, REPO_ROOT)}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+"""Loads site.py as a module, for the benchmarks and the tests."""
+import os
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+QUOTA_VARIABLES = ('GSHEET_SHEETS_USER_CALLS_PER_MINUTE', 'GSHEET_SHEETS_PROJECT_CALLS_PER_MINUTE',
+                   'GSHEET_DRIVE_USER_CALLS_PER_MINUTE', 'GSHEET_DRIVE_PROJECT_CALLS_PER_MINUTE')
+
+
+def load_site(lift_quotas=False, scratch_db=False):
+    """Import site.py the way serve.py does and return it.
+
+    The app gets a new empty database when scratch_db is set or GSHEET_DB
+    is not.
+    """
+    if lift_quotas:
+        for variable in QUOTA_VARIABLES:
+            os.environ.setdefault(variable, '1000000')
+    if scratch_db or 'GSHEET_DB' not in os.environ:
+        os.environ['GSHEET_DB'] = os.path.join(tempfile.mkdtemp(prefix='gsheet-'), 'gsheet_ui.db')
+    os.chdir(REPO_ROOT)
+    # Appended rather than prepended so the stdlib site module is not shadowed
+    if REPO_ROOT not in sys.path:
+        sys.path.append(REPO_ROOT)
+    from serve import load_app
+    return load_app()
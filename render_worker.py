@@ -0,0 +1,22 @@
+"""Fills exported template workbooks for site.py's local render mode.
+
+Imported by the render worker processes, so it imports nothing but
+openpyxl and must stay free of the app's own imports.
+"""
+import io
+
+
+def fill_workbook(template_path, plan):
+    """Write a character's (A1 range, value) pairs into the exported template.
+
+    Returns the filled workbook as .xlsx bytes. A range over merged cells
+    is written to its top-left cell.
+    """
+    import openpyxl
+    workbook = openpyxl.load_workbook(template_path)
+    for cell_range, value in plan:
+        title, _, cells = cell_range.rpartition('!')
+        workbook[title.strip("'")][cells.split(':')[0]] = value
+    output = io.BytesIO()
+    workbook.save(output)
+    return output.getvalue()
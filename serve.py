@@ -0,0 +1,32 @@
+"""Starts GSheet-UI.
+
+    python serve.py                        # Flask development server
+    GSHEET_SERVER=gevent python serve.py   # gevent server on GSHEET_PORT
+    python serve.py authorize              # store a Google token and exit
+
+The app itself is site.py, loaded by path because its name would otherwise
+resolve to the stdlib site module. Local render workers re-import the main
+script, so this one is kept to a few stdlib imports.
+"""
+import importlib.util
+import os
+import sys
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_app():
+    """Import site.py as the gsheet_site module and return it."""
+    spec = importlib.util.spec_from_file_location('gsheet_site', os.path.join(APP_DIR, 'site.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+if __name__ == '__main__':
+    if os.environ.get('GSHEET_SERVER') == 'gevent':
+        # Must run before anything creates threads or locks
+        from gevent import monkey
+        monkey.patch_all()
+    load_app().main(sys.argv[1:])
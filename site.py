@@ -1,577 +1,2733 @@
-import json
-import os.path
-from flask import Flask, request, render_template, jsonify
-from flask_cors import CORS
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-
-# Initialize Flask app with proper configuration
-app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "*"}})
-
-# Google API scopes
-SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-
-# Define subclass levels for each class
-dnd_subclass_levels = {
-    "Barbarian": 3,
-    "Bard": 3,
-    "Illrigger": 3,
-    "Cleric": 1,
-    "Druid": 2,
-    "Fighter": 3,
-    "Jaeger": 3,
-    "Monk": 3,
-    "Paladin": 3,
-    "Ranger": 3,
-    "Rogue": 3,
-    "Sorcerer": 3,
-    "Warlock": 1,
-    "Witch": 3,
-    "Wizard": 2,
-}
-
-# Subclasses for each class
-dnd_subclasses = {
-    'Barbarian': ['Path of the Berserker', 'Path of the Totem Warrior'],
-    'Bard': ['College of Lore', 'College of Valor'],
-    'Cleric': ['Knowledge Domain', 'Life Domain', 'Light Domain', 'Nature Domain', 'Tempest Domain', 'Trickery Domain', 'War Domain'],
-    'Druid': ['Circle of the Land', 'Circle of the Moon'],
-    'Fighter': ['Champion', 'Battle Master', 'Eldritch Knight'],
-    "Illrigger": ['Path of the Bloodrager', 'Path of the Soulblade', 'Path of the Warbringer'],
-    'Jaeger': ['Sanguine', 'Salvation', 'Absolute', 'Heretic'],
-    'Monk': ['Way of the Open Hand', 'Way of Shadow', 'Way of the Four Elements'],
-    'Paladin': ['Oath of Devotion', 'Oath of the Ancients', 'Oath of Vengeance'],
-    'Ranger': ['Hunter', 'Beast Master'],
-    'Rogue': ['Thief', 'Assassin', 'Arcane Trickster'],
-    'Sorcerer': ['Draconic Bloodline', 'Wild Magic'],
-    'Warlock': ['The Archfey', 'The Fiend', 'The Great Old One'],
-    'Witch': ['Black Magic', 'Blood Magic', 'Green Magic', 'Purple Magic', 'Red Magic', 'Steel Magic', 'Tea Magic', 'Technicolor Magic', 'White Magic', 'Yellow Magic'],
-    'Wizard': ['School of Abjuration', 'School of Conjuration', 'School of Divination', 'School of Enchantment', 'School of Evocation', 'School of Illusion', 'School of Necromancy', 'School of Transmutation']
-}
-
-# Define DnD classes at the global scope
-dnd_classes = [
-    'Barbarian', 'Bard', 'Cleric', 'Druid', 'Fighter', 'Illrigger',
-    'Monk', 'Paladin', 'Ranger', 'Jaeger', 'Rogue', 'Sorcerer',
-    'Warlock', 'Witch', 'Wizard'
-]
-
-# Example spell data
-dnd_spells = {
-    "Wizard": {
-        0: [],
-        1: ["Magic Missile", "Shield"],
-        2: ["Misty Step", "Scorching Ray"],
-        3: [],
-        4: [],
-        5: [],
-        6: [],
-        7: [],
-        8: [],
-        9: [],
-    },
-    "Cleric": {
-        0: [],
-        1: ["Cure Wounds", "Guiding Bolt"],
-        2: ["Lesser Restoration", "Spiritual Weapon"],
-        3: [],
-        4: [],
-        5: [],
-        6: [],
-        7: [],
-        8: [],
-        9: [],
-    },
-    "Sorcerer": {
-        0: [],
-        1: ["Magic Missile", "Shield"],
-        2: ["Misty Step", "Scorching Ray"],
-        3: [],
-        4: [],
-        5: [],
-        6: [],
-        7: [],
-        8: [],
-        9: [],
-    },
-    "Warlock": {
-        0: [],
-        1: ["Hex", "Armor of Agathys"],
-        2: ["Mirror Image", "Misty Step"],
-        3: ["Counterspell", "Dispel Magic"],
-        4: ["Banishment", "Dimension Door"],
-        5: ["Hold Monster", "Wall of Force"],
-        6: [],
-        7: [],
-        8: [],
-        9: [],
-    },
-    "Bard": {
-        0: ["Vicious Mockery", "Prestidigitation", "Minor Illusion"],
-        1: ["Charm Person", "Healing Word", "Disguise Self"],
-        2: ["Invisibility", "Suggestion", "Heat Metal"],
-        3: ["Hypnotic Pattern", "Major Image", "Leomund’s Tiny Hut"],
-        4: ["Dimension Door", "Polymorph"],
-        5: ["Dominate Person", "Hold Monster"],
-        6: ["Mass Suggestion", "Otto’s Irresistible Dance"],
-        7: ["Forcecage", "Mirage Arcane"],
-        8: ["Dominate Monster", "Power Word Stun"],
-        9: ["Foresight", "True Polymorph"],
-    },
-    "Druid": {
-        0: ["Druidcraft", "Guidance", "Produce Flame"],
-        1: ["Entangle", "Faerie Fire", "Healing Word"],
-        2: ["Flaming Sphere", "Moonbeam", "Spike Growth"],
-        3: ["Call Lightning", "Plant Growth", "Wind Wall"],
-        4: ["Polymorph", "Stone Shape"],
-        5: ["Mass Cure Wounds", "Wall of Stone"],
-        6: ["Move Earth", "Sunbeam"],
-        7: ["Fire Storm", "Reverse Gravity"],
-        8: ["Earthquake", "Sunburst"],
-        9: ["Shapechange", "Mass Heal"],
-    },
-    "Ranger": {
-        0: ["Hunter’s Mark", "Druidcraft"],
-        1: ["Hunter’s Mark", "Cure Wounds"],
-        2: ["Pass without Trace", "Spike Growth"],
-        3: ["Conjure Animals", "Lightning Arrow"],
-        4: ["Freedom of Movement", "Grasping Vine"],
-        5: ["Swift Quiver", "Steel Wind Strike"],
-        6: [],
-        7: [],
-        8: [],
-        9: [],
-    },
-    "Paladin": {
-        0: [],
-        1: ["Shield of Faith", "Cure Wounds"],
-        2: ["Lesser Restoration", "Magic Weapon"],
-        3: ["Aura of Vitality", "Revivify"],
-        4: ["Death Ward", "Staggering Smite"],
-        5: ["Greater Restoration", "Raise Dead"],
-        6: [],
-        7: [],
-        8: [],
-        9: [],
-    },
-    "Witch": {
-        0: [],
-        1: ["Hex", "Mage Armor"],
-        2: ["Blindness/Deafness", "Hold Person"],
-        3: ["Counterspell", "Dispel Magic"],
-        4: ["Banishment", "Dimension Door"],
-        5: ["Hold Monster", "Wall of Force"],
-        6: [],
-        7: [],
-        8: [],
-        9: [],
-    },
-    "Barbarian": {
-        0: [],
-        1: [],  # Barbarians typically do not have spells
-        # ...additional levels if needed...
-    },
-    "Fighter": {
-        0: [],
-        1: [],  # Fighters may gain spells at higher levels or via subclasses
-        # ...additional levels if needed...
-    },
-    "Monk": {
-        0: [],
-        1: [],  # Monks typically do not have spells
-        # ...additional levels if needed...
-    },
-    "Rogue": {
-        0: [],
-        1: [],  # Rogues typically do not have spells
-        # ...additional levels if needed...
-    },
-    # Add other classes as needed
-}
-
-# Define caster progression for each class
-caster_progression = {
-    "Wizard": {
-        1: {"1st": 2},
-        2: {"1st": 3},
-        3: {"1st": 4, "2nd": 2},
-        4: {"1st": 4, "2nd": 3},
-        5: {"1st": 4, "2nd": 3, "3rd": 2},
-        6: {"1st": 4, "2nd": 3, "3rd": 3},
-        7: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 1},
-        8: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 2},
-        9: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 1},
-        10: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2},
-        11: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1},
-        12: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1},
-        13: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1},
-        14: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1},
-        15: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1},
-        16: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1},
-        17: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        18: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        19: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        20: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-    },
-    "Cleric": {
-        1: {"1st": 2},
-        2: {"1st": 3},
-        3: {"1st": 4, "2nd": 2},
-        4: {"1st": 4, "2nd": 3},
-        5: {"1st": 4, "2nd": 3, "3rd": 2},
-        6: {"1st": 4, "2nd": 3, "3rd": 3},
-        7: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 1},
-        8: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 2},
-        9: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 1},
-        10: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2},
-        11: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1},
-        12: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1},
-        13: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1},
-        14: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1},
-        15: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1},
-        16: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1},
-        17: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        18: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        19: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        20: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-    },
-    "Druid": {
-        1: {"1st": 2},
-        2: {"1st": 3},
-        3: {"1st": 4, "2nd": 2},
-        4: {"1st": 4, "2nd": 3},
-        5: {"1st": 4, "2nd": 3, "3rd": 2},
-        6: {"1st": 4, "2nd": 3, "3rd": 3},
-        7: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 1},
-        8: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 2},
-        9: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 1},
-        10: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2},
-        11: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1},
-        12: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1},
-        13: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1},
-        14: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1},
-        15: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1},
-        16: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1},
-        17: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        18: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        19: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        20: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-    },
-    "Bard": {
-        1: {"1st": 2},
-        2: {"1st": 3},
-        3: {"1st": 4, "2nd": 2},
-        4: {"1st": 4, "2nd": 3},
-        5: {"1st": 4, "2nd": 3, "3rd": 2},
-        6: {"1st": 4, "2nd": 3, "3rd": 3},
-        7: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 1},
-        8: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 2},
-        9: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 1},
-        10: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2},
-        11: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1},
-        12: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1},
-        13: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1},
-        14: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1},
-        15: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1},
-        16: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1},
-        17: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        18: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        19: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        20: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-    },
-    "Sorcerer": {
-        1: {"1st": 2},
-        2: {"1st": 3},
-        3: {"1st": 4, "2nd": 2},
-        4: {"1st": 4, "2nd": 3},
-        5: {"1st": 4, "2nd": 3, "3rd": 2},
-        6: {"1st": 4, "2nd": 3, "3rd": 3},
-        7: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 1},
-        8: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 2},
-        9: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 1},
-        10: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2},
-        11: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1},
-        12: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1},
-        13: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1},
-        14: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1},
-        15: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1},
-        16: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1},
-        17: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        18: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        19: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-        20: {"1st": 4, "2nd": 3, "3rd": 3, "4th": 3, "5th": 2, "6th": 1, "7th": 1, "8th": 1, "9th": 1},
-    },
-    # Add other caster classes as needed
-}
-
-
-def get_google_credentials():
-    """Get or refresh Google API credentials."""
-    creds = None
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
-    return creds
-
-def calculate_point_buy(scores):
-    MIN_SCORE = 6
-    MAX_SCORE = 18
-
-    def calculate_points(score):
-        # This formula calculates the point cost for a given ability score based on a custom polynomial equation.
-        return round(0.01515 * score ** 3 - 0.4196 * score ** 2 + 4.739 * score - 18.701)
-
-    if not all(MIN_SCORE <= score <= MAX_SCORE for score in scores):
-        return {'is_valid': False, 'total': 0, 'individual_costs': []}
-    individual_costs = [calculate_points(score) for score in scores]
-    total = sum(individual_costs)
-    return {
-        'is_valid': total <= 35,
-        'total': total,
-        'individual_costs': individual_costs
-    }
-
-def process_request(form_data):
-    character_name = form_data.get('character_name')
-    primary_class_data = extract_primary_class_data(form_data)
-    multiclass_data = extract_multiclass_data(form_data)
-    class_string = primary_class_data
-    if multiclass_data:
-        class_string += f", {multiclass_data}"
-    new_sheet_id = copy_entire_sheet('1Mx-R-sDVDcV-tEMXz0KrMlKij2BejMXD9AYxp3O6OX4', character_name)
-    if new_sheet_id:
-        update_character_sheet(character_name, class_string, form_data, new_sheet_id)
-    else:
-        print("Failed to copy the sheet.")
-        return None
-    return new_sheet_id
-
-def extract_primary_class_data(form_data):
-    class_data = form_data.get('class_data', [])
-    if class_data:
-        primary = class_data[0]
-        character_class = primary.get('class')
-        character_level = primary.get('level')
-        character_subclass = primary.get('subclass')
-
-        if character_class:
-            if character_subclass:
-                primary_class_data = f"{character_subclass} {character_class} {character_level}"
-            else:
-                primary_class_data = f"{character_class} {character_level}"
-            print(f"Added primary class: {primary_class_data}")
-            return primary_class_data
-    print("No primary class provided")
-    return ""
-
-def extract_multiclass_data(form_data):
-    class_data = form_data.get('class_data', [])
-    if len(class_data) > 1:
-        multiclass_entries = class_data[1:]
-        class_string = ", ".join([
-            f"{entry['subclass']} {entry['class']} {entry['level']}" if entry.get('subclass') else f"{entry['class']} {entry['level']}"
-            for entry in multiclass_entries
-        ])
-        print(f"Generated multiclass string: {class_string}")
-        return class_string
-    return ""
-
-def copy_entire_sheet(spreadsheet_id, new_spreadsheet_title):
-    creds = get_google_credentials()
-    if creds is None:
-        print("Failed to obtain Google credentials.")
-        return None
-
-    try:
-        service = build('drive', 'v3', credentials=creds)
-        # Copy the entire spreadsheet
-        copied_sheet = service.files().copy(
-            fileId=spreadsheet_id,
-            body={'name': new_spreadsheet_title}
-        ).execute()
-        print(f"Copied sheet ID: {copied_sheet['id']}")
-        return copied_sheet['id']
-    except HttpError as err:
-        print(f"An error occurred: {err}")
-        return None
-
-@app.route('/copy_sheet', methods=['POST'])
-def copy_sheet_route():
-    data = request.json
-    spreadsheet_id = data.get('spreadsheet_id')
-    new_spreadsheet_title = data.get('new_spreadsheet_title')
-    new_sheet_id = copy_entire_sheet(spreadsheet_id, new_spreadsheet_title)
-    if new_sheet_id:
-        return jsonify({'new_sheet_id': new_sheet_id}), 200
-    else:
-        return jsonify({'error': 'Failed to copy sheet'}), 500
-
-def update_character_sheet(character_name, class_string, form_data, spreadsheet_id):
-    creds = get_google_credentials()
-    try:
-        service = build('sheets', 'v4', credentials=creds)
-        sheet = service.spreadsheets()
-
-        sheet_metadata = sheet.get(spreadsheetId=spreadsheet_id).execute()
-        sheet_name = sheet_metadata['sheets'][0]['properties']['title']
-
-        # Update character name and class
-        update_sheet_value(sheet, spreadsheet_id, f'{sheet_name}!C6', character_name)
-        update_sheet_value(sheet, spreadsheet_id, f'{sheet_name}!T5', class_string)
-
-        # Update ability scores
-        ability_scores = [
-            ('C16', int(form_data.get('strength'))),
-            ('C21', int(form_data.get('dexterity'))),
-            ('C26', int(form_data.get('constitution'))),
-            ('C31', int(form_data.get('intelligence'))),
-            ('C36', int(form_data.get('wisdom'))),
-            ('C41', int(form_data.get('charisma')))
-        ]
-
-        for cell, value in ability_scores:
-            update_sheet_value(sheet, spreadsheet_id, f'{sheet_name}!{cell}', value)
-
-        # Update spells
-        spells = form_data.get('spells', [])
-        print(f"Raw spells: {spells}")
-
-        try:
-            # Group spells by level
-            spell_groups = {}
-            for spell in spells:
-                if ':' in spell:
-                    level, spell_name = spell.split(':', 1)
-                    level = level.strip()
-                    spell_name = spell_name.strip()
-                    if level not in spell_groups:
-                        spell_groups[level] = []
-                    spell_groups[level].append(spell_name)
-            
-            print(f"Grouped spells: {spell_groups}")
-
-            # Define spell cell mappings
-            spell_cells = {
-                '1': ['D100:J100', 'N100:T100', 'X100:AD100', 'D101:J101', 
-                      'D102:J102', 'D103:J103', 'D104:J104', 'N104:T104', 'N101:T101', 'N102:T102', 'N103:T103', 
-                      'X101:AD101', 'X102:AD102', 'X103:AD103', 'X104:AD104'],
-                '2': ['N106:T106', 'N107:T107', 'N108:T108', 'N109:T109', 'N110:T110', "X106:AD106", "X107:AD107", "X108:AD108", "X109:AD109", "X110:AD110", "AH106:AN106", "AH107:AN107", "AH108:AN108", "AH109:AN109", ""],
-            }
-
-            # Update spells for each level
-            for level, level_spells in spell_groups.items():
-                if level in spell_cells:
-                    cells = spell_cells[level]
-                    for idx, spell in enumerate(level_spells):
-                        if idx < len(cells):
-                            cell_range = f'{sheet_name}!{cells[idx]}'
-                            print(f"Updating {level} spell: {spell} in cell {cell_range}")
-                            update_sheet_value(sheet, spreadsheet_id, cell_range, spell)
-
-        except Exception as err:
-            print(f"Error processing spells: {err}")
-            print(f"Error details: {str(err)}")
-
-    except HttpError as err:
-        print(f"An error occurred: {err}")
-
-def update_sheet_value(sheet, spreadsheet_id, cell_range, value):
-    try:
-        sheet.values().update(
-            spreadsheetId=spreadsheet_id,
-            range=cell_range,
-            valueInputOption='RAW',
-            body={'values': [[value]]}
-        ).execute()
-    except HttpError as err:
-        print(f"An error occurred while updating the sheet: {err}")
-
-@app.route('/validate_points', methods=['POST'])
-def validate_points():
-    scores = request.json.get('scores', [])
-    if not isinstance(scores, list) or not all(isinstance(score, int) for score in scores):
-        return jsonify({'error': 'Invalid input. Scores must be a list of integers.'}), 400
-    result = calculate_point_buy(scores)
-    return jsonify(result)
-
-@app.route('/get_subclasses/<string:class_name>', methods=['GET'])
-def get_subclasses(class_name):
-    """Return subclasses for a specific class."""
-    subclasses = dnd_subclasses.get(class_name, [])
-    subclass_level = dnd_subclass_levels.get(class_name, 0)
-    return jsonify({'subclasses': subclasses, 'level_required': subclass_level})
-
-@app.route('/get_spells/<string:class_name>', methods=['GET'])
-def get_spells_route(class_name):
-    return get_spells(class_name)
-
-def get_spells(class_name):
-    """Endpoint to get spells for a given class."""
-    spells = dnd_spells.get(class_name, {})
-    # Example response structure
-    response = {
-        "level_required": 1,  # Adjust as needed per class
-        "spells": spells
-    }
-    return jsonify(response)
-
-def get_combined_spells(class_names):
-    """Return combined spells for a list of classes."""
-    combined_spells = []
-    for class_name in class_names:
-        spells = dnd_spells.get(class_name, {})
-        for level, spell_list in spells.items():
-            for spell in spell_list:
-                combined_spells.append(f"Level {level}: {spell}")
-    # Remove duplicates and sort
-    combined_spells = sorted(list(set(combined_spells)))
-    return combined_spells
-
-@app.route('/get_combined_spells', methods=['POST'])
-def get_combined_spells_route():
-    data = request.json
-    class_names = data.get('class_names', [])
-    if not isinstance(class_names, list) or not all(isinstance(cls, str) for cls in class_names):
-        return jsonify({'error': 'Invalid input. class_names must be a list of strings.'}), 400
-    spells = get_combined_spells(class_names)
-    return jsonify({'spells': spells})
-
-@app.route('/', methods=['GET', 'POST'])
-def index():
-    if request.method == 'POST':
-        try:
-            form_data = request.get_json()
-            print(f"Received form data: {form_data}")
-            new_sheet_id = process_request(form_data)
-            return jsonify({'character_name': form_data.get('character_name'), 'sheet_id': new_sheet_id})
-        except Exception as e:
-            print(f"Error occurred: {e}")
-            return jsonify({'error': str(e)}), 500
-    else:
-        return render_template('index.html', classes=dnd_classes, subclasses=dnd_subclasses)
-
-@app.route('/result')
-def result():
-    sheet_id = request.args.get('sheet_id')
-    character_name = request.args.get('character_name')
-    return render_template('result.html', sheet_id=sheet_id, character_name=character_name)
-
-@app.errorhandler(Exception)
-def handle_error(error):
-    """Global error handler."""
-    print(f"Error occurred: {str(error)}")
-    return render_template('index.html', error=str(error), classes=dnd_classes)
-
-if __name__ == '__main__':
-    app.run(debug=True)
+import os
+import sys
+
+if __name__ == '__main__':
+    # Local render workers re-import the main script, which must not be the whole app
+    sys.exit("Start GSheet-UI with: python serve.py")
+
+import bisect
+import csv
+import functools
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import logging
+import multiprocessing
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from itertools import combinations_with_replacement
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, g, redirect, request, render_template, jsonify
+from flask_cors import CORS
+# Only the exception class is imported eagerly; see load_google_clients()
+from googleapiclient.errors import HttpError
+
+import render_worker
+
+try:
+    import brotli
+except ImportError:  # Optional: responses are still offered gzip-compressed
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows: token refreshes are then only coordinated within a process
+    fcntl = None
+
+# Initialize Flask app with proper configuration
+app = Flask(__name__)
+CORS(app, resources={r"/*": {"origins": "*"}})
+
+# Application logger; GSHEET_LOG_LEVEL=DEBUG also logs form data and cell writes
+logger = logging.getLogger('gsheet_ui')
+logger.setLevel(os.environ.get('GSHEET_LOG_LEVEL', 'INFO').upper())
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(threadName)s] %(message)s'))
+    logger.addHandler(_log_handler)
+
+# Google API scopes
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+
+# Refresh access tokens this long before they actually expire
+CREDENTIAL_REFRESH_MARGIN = timedelta(minutes=5)
+
+# OAuth token shared by every worker process, and the client secrets `python site.py authorize` uses
+TOKEN_FILE = os.environ.get('GSHEET_TOKEN_FILE', 'token.json')
+CLIENT_SECRETS_FILE = os.environ.get('GSHEET_CLIENT_SECRETS_FILE', 'credentials.json')
+
+# Socket timeout (seconds) for Google API connections
+GOOGLE_HTTP_TIMEOUT = 60
+
+# Template every character sheet is copied from
+TEMPLATE_SPREADSHEET_ID = '1Mx-R-sDVDcV-tEMXz0KrMlKij2BejMXD9AYxp3O6OX4'
+
+# Google API request budgets per minute. Each call must fit both the per-user and
+# the per-project quota of its API.
+SHEETS_USER_CALLS_PER_MINUTE = int(os.environ.get('GSHEET_SHEETS_USER_CALLS_PER_MINUTE', '60'))
+SHEETS_PROJECT_CALLS_PER_MINUTE = int(os.environ.get('GSHEET_SHEETS_PROJECT_CALLS_PER_MINUTE', '300'))
+DRIVE_USER_CALLS_PER_MINUTE = int(os.environ.get('GSHEET_DRIVE_USER_CALLS_PER_MINUTE', '180'))
+DRIVE_PROJECT_CALLS_PER_MINUTE = int(os.environ.get('GSHEET_DRIVE_PROJECT_CALLS_PER_MINUTE', '12000'))
+
+# Server processes sharing those budgets (gunicorn's WEB_CONCURRENCY if set); each
+# process schedules its calls within an equal share
+GOOGLE_API_PROCESSES = max(1, int(os.environ.get('GSHEET_WORKER_PROCESSES',
+                                                 os.environ.get('WEB_CONCURRENCY', '1'))))
+
+# Maximum number of Google API calls in flight at once
+GOOGLE_API_MAX_CONCURRENCY = int(os.environ.get('GSHEET_GOOGLE_API_MAX_CONCURRENCY', '8'))
+
+# Retries for rate-limited or failed Google API calls, with exponential backoff and jitter
+GOOGLE_API_MAX_RETRIES = int(os.environ.get('GSHEET_GOOGLE_API_MAX_RETRIES', '5'))
+GOOGLE_API_BACKOFF_BASE = 1.0
+GOOGLE_API_BACKOFF_MAX = 32.0
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RETRYABLE_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+# Run background character jobs as coroutines on the asyncio Google transport
+ASYNC_GOOGLE = os.environ.get('GSHEET_ASYNC_GOOGLE', '0') == '1'
+
+# Google calls the asyncio transport keeps in flight at once
+ASYNC_MAX_IN_FLIGHT = int(os.environ.get('GSHEET_ASYNC_MAX_IN_FLIGHT', '100'))
+
+# Number of blank template copies kept ready for new characters (0 disables the pool)
+TEMPLATE_POOL_SIZE = int(os.environ.get('GSHEET_TEMPLATE_POOL_SIZE', '0'))
+
+# The pool is refilled in the background once fewer than this many copies are ready
+TEMPLATE_POOL_LOW_WATER = int(os.environ.get('GSHEET_TEMPLATE_POOL_LOW_WATER', '2'))
+
+# Title given to pooled copies until a character claims them
+POOLED_SHEET_TITLE = 'Unclaimed character sheet'
+
+# Seconds the cached template layout is trusted before the template's Drive
+# version is checked again
+TEMPLATE_LAYOUT_TTL = int(os.environ.get('GSHEET_TEMPLATE_LAYOUT_TTL', '300'))
+
+# Fill each character into a local export of the template and upload it in one call (needs openpyxl)
+LOCAL_RENDER = os.environ.get('GSHEET_LOCAL_RENDER', '0') == '1'
+
+# Where exports of the template are cached, one file per Drive version
+TEMPLATE_EXPORT_DIR = os.environ.get('GSHEET_TEMPLATE_EXPORT_DIR', 'template_exports')
+
+# Worker processes filling character workbooks in local render mode
+LOCAL_RENDER_WORKERS = int(os.environ.get('GSHEET_LOCAL_RENDER_WORKERS', str(os.cpu_count() or 2)))
+
+# Number of background workers creating character sheets
+JOB_WORKERS = int(os.environ.get('GSHEET_JOB_WORKERS', '4'))
+
+# Maximum number of queued plus running jobs; further submissions wait in the outbox
+JOB_QUEUE_LIMIT = int(os.environ.get('GSHEET_JOB_QUEUE_LIMIT', '50'))
+
+# Number of jobs remembered for status lookups
+JOB_HISTORY_LIMIT = int(os.environ.get('GSHEET_JOB_HISTORY_LIMIT', '1000'))
+
+# Seconds between keep-alive comments on an idle progress stream
+SSE_KEEPALIVE = float(os.environ.get('GSHEET_SSE_KEEPALIVE', '15'))
+
+# Local SQLite database for submission bookkeeping
+DATABASE_FILE = os.environ.get('GSHEET_DB', 'gsheet_ui.db')
+
+# Seconds a submission is remembered, so repeating it returns the same sheet
+IDEMPOTENCY_TTL = int(os.environ.get('GSHEET_IDEMPOTENCY_TTL', '86400'))
+
+# Seconds after which an unfinished submission is presumed abandoned and may run again
+IDEMPOTENCY_PENDING_TIMEOUT = int(os.environ.get('GSHEET_IDEMPOTENCY_PENDING_TIMEOUT', '900'))
+
+# Seconds between outbox scans for characters to start or retry
+OUTBOX_POLL_INTERVAL = float(os.environ.get('GSHEET_OUTBOX_POLL_INTERVAL', '5'))
+
+# Attempts at creating a character before it is marked failed
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('GSHEET_OUTBOX_MAX_ATTEMPTS', '8'))
+
+# Seconds before the first retry of a failed attempt, doubling up to OUTBOX_RETRY_MAX
+OUTBOX_RETRY_DELAY = float(os.environ.get('GSHEET_OUTBOX_RETRY_DELAY', '30'))
+OUTBOX_RETRY_MAX = float(os.environ.get('GSHEET_OUTBOX_RETRY_MAX', '1800'))
+
+# Seconds a worker may hold a character before it is presumed crashed and replayed
+OUTBOX_LEASE = float(os.environ.get('GSHEET_OUTBOX_LEASE', '600'))
+
+# Seconds finished outbox entries are kept before compaction
+OUTBOX_RETENTION = float(os.environ.get('GSHEET_OUTBOX_RETENTION', '86400'))
+
+# Number of characters a bulk import creates concurrently
+BULK_WORKERS = int(os.environ.get('GSHEET_BULK_WORKERS', '4'))
+
+# Largest number of characters accepted in one bulk import
+BULK_MAX_CHARACTERS = int(os.environ.get('GSHEET_BULK_MAX_CHARACTERS', '200'))
+
+# Rules tables shipped next to this file
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules.json')
+
+SLOT_ORDINALS = ('1st', '2nd', '3rd', '4th', '5th', '6th', '7th', '8th', '9th')
+
+class SpellSlotCalculator:
+    """Spell slots for any mix of classes, from lookup tables built once.
+
+    Each caster type has a tuple of slot rows indexed by its class level,
+    all sharing the full caster's rows, and a tuple of the caster level each
+    class level adds when multiclassing. Resolving a character is one
+    lookup per class entry plus one row lookup, however the levels combine.
+    """
+
+    # Class level divided (rounding down) into multiclass caster level
+    CASTER_DIVISORS = {'full': 1, 'half': 2, 'third': 3}
+
+    def __init__(self, slot_table, pact_slots, class_types, subclass_types):
+        full = ((),) + tuple(tuple(row) for row in slot_table)
+        self.max_level = len(full) - 1
+        levels = range(self.max_level + 1)
+        # A lone half or third caster rounds up and has no slots before level 2 or 3
+        self.single_caster_levels = {
+            caster_type: tuple(-(-level // divisor) if level >= divisor else 0 for level in levels)
+            for caster_type, divisor in self.CASTER_DIVISORS.items()
+        }
+        self.slot_rows = {
+            caster_type: tuple(full[caster_level] for caster_level in caster_levels)
+            for caster_type, caster_levels in self.single_caster_levels.items()
+        }
+        self.caster_levels = {
+            caster_type: tuple(level // divisor for level in levels)
+            for caster_type, divisor in self.CASTER_DIVISORS.items()
+        }
+        self.pact_rows = ((0, 0),) + tuple(tuple(row) for row in pact_slots)
+        self.class_types = dict(class_types)
+        self.subclass_types = dict(subclass_types)
+
+    def caster_type(self, class_name, subclass=None):
+        """Return 'full', 'half', 'third', 'pact' or None for a class and subclass."""
+        return self.class_types.get(class_name) or self.subclass_types.get(subclass)
+
+    def progression(self):
+        """Return {class: {class level: {slot ordinal: count}}} for every casting class.
+
+        Classes of the same type share one table. Pact slots are listed at
+        their slot level.
+        """
+        tables = {
+            caster_type: {level: dict(zip(SLOT_ORDINALS, rows[level])) for level in range(1, self.max_level + 1)}
+            for caster_type, rows in self.slot_rows.items()
+        }
+        tables['pact'] = {level: {SLOT_ORDINALS[slot_level - 1]: count}
+                          for level, (count, slot_level) in enumerate(self.pact_rows) if level}
+        return {class_name: tables[caster_type] for class_name, caster_type in self.class_types.items()}
+
+    def slots(self, class_data):
+        """Return the spell slots of a character's class_data entries.
+
+        A single spellcasting class uses its own table; several combine
+        into one caster level on the full caster table. Pact magic is
+        reported on its own. Raises ValueError for a level that is not
+        between 1 and the highest level.
+        """
+        casters = []
+        pact_level = 0
+        for entry in class_data:
+            level = int(entry.get('level') or 0)
+            if not 1 <= level <= self.max_level:
+                raise ValueError(f"Level must be between 1 and {self.max_level}, got {level}")
+            caster_type = self.caster_type(entry.get('class'), entry.get('subclass'))
+            if caster_type == 'pact':
+                pact_level = min(pact_level + level, self.max_level)
+            elif caster_type is not None:
+                casters.append((caster_type, level))
+
+        if len(casters) == 1:
+            caster_type, level = casters[0]
+            caster_level = self.single_caster_levels[caster_type][level]
+            row = self.slot_rows[caster_type][level]
+        else:
+            caster_level = min(sum(self.caster_levels[caster_type][level] for caster_type, level in casters),
+                               self.max_level)
+            row = self.slot_rows['full'][caster_level]
+
+        pact_count, pact_slot_level = self.pact_rows[pact_level]
+        return {
+            'caster_level': caster_level,
+            'slots': dict(zip(SLOT_ORDINALS, row)),
+            'pact_magic': {'slots': pact_count, 'slot_level': pact_slot_level} if pact_level else None,
+        }
+
+def load_rules(path=RULES_FILE):
+    """Read the compact rules file into the tables the routes serve.
+
+    Returns (classes, subclasses, subclass_levels, spells, slot_calculator).
+    Spell lists are keyed by spell level; the calculator holds the spell
+    slot tables of every caster type.
+    """
+    with open(path, encoding='utf-8') as rules_file:
+        rules = json.load(rules_file)
+    spells = {class_name: dict(enumerate(levels)) for class_name, levels in rules['spells'].items()}
+    slot_calculator = SpellSlotCalculator(rules['slot_tables']['full'], rules['pact_slots'],
+                                          rules['caster_progression'], rules['subclass_caster_progression'])
+    return rules['classes'], rules['subclasses'], rules['subclass_levels'], spells, slot_calculator
+
+dnd_classes, dnd_subclasses, dnd_subclass_levels, dnd_spells, spell_slot_calculator = load_rules()
+caster_progression = spell_slot_calculator.progression()
+
+
+# Histogram buckets (seconds) for request and span latencies
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRIC_HELP = {
+    'gsheet_http_request_duration_seconds': ('histogram', 'Time spent handling HTTP requests, by route.'),
+    'gsheet_span_duration_seconds': ('histogram', 'Time spent in each stage of character creation.'),
+    'gsheet_google_api_calls_total': ('counter', 'Google API requests sent, including retries.'),
+    'gsheet_google_api_throttled_total': ('counter', 'Google API calls delayed by the rate limiter.'),
+    'gsheet_google_api_retried_total': ('counter', 'Google API calls retried after an error.'),
+    'gsheet_google_api_failed_total': ('counter', 'Google API calls that failed for good.'),
+    'gsheet_google_api_bytes_sent_total': ('counter', 'Request body bytes sent to Google APIs.'),
+}
+
+class Metrics:
+    """Thread-safe counters and histograms rendered in the Prometheus text format."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            # Buckets are stored non-cumulatively and summed when rendered
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def counter_total(self, name):
+        with self.lock:
+            return sum(value for (counter_name, _), value in self.counters.items() if counter_name == name)
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(value, buckets=list(value['buckets'])))
+                                for key, value in self.histograms.items())
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described and name in METRIC_HELP:
+                metric_type, help_text = METRIC_HELP[name]
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                described.add(name)
+
+        for (name, labels), value in counters:
+            describe(name)
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            describe(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", repr(bound)),))} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {histogram["count"]}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {histogram["sum"]}')
+            lines.append(f'{name}_count{_format_labels(labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (f'{key}="{_escape_label(value)}"' for key, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = Metrics()
+
+@contextmanager
+def timed_span(name):
+    """Record how long the enclosed block takes as one stage of character creation."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe('gsheet_span_duration_seconds', elapsed, span=name)
+        logger.debug("%s took %.1f ms", name, elapsed * 1000)
+
+# Per-thread API clients; httplib2 connections must not be shared between threads
+_service_cache = threading.local()
+
+# Optional factory returning an httplib2-compatible object that API clients send
+# their requests through instead of Google (used by benchmarks/fake_google.py)
+google_http_factory = None
+
+# Google client libraries, imported by load_google_clients() on first use
+httplib2 = Request = RefreshError = AuthorizedHttp = Credentials = InstalledAppFlow = MediaIoBaseUpload = build = None
+_google_import_lock = threading.Lock()
+
+def load_google_clients():
+    """Import the Google client and auth libraries.
+
+    They account for most of this module's import time and memory, and
+    workers that only serve rules or point-buy requests never need them.
+    """
+    global httplib2, Request, RefreshError, AuthorizedHttp, Credentials, InstalledAppFlow, MediaIoBaseUpload, build
+    if build is not None:
+        return
+    with _google_import_lock, timed_span('google_import'):
+        if build is not None:
+            return
+        import httplib2 as _httplib2
+        from google.auth.exceptions import RefreshError as _RefreshError
+        from google.auth.transport.requests import Request as _Request
+        from google_auth_httplib2 import AuthorizedHttp as _AuthorizedHttp
+        from google.oauth2.credentials import Credentials as _Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow as _InstalledAppFlow
+        from googleapiclient.discovery import build as _build
+        from googleapiclient.http import MediaIoBaseUpload as _MediaIoBaseUpload
+        httplib2, Request, RefreshError, AuthorizedHttp = _httplib2, _Request, _RefreshError, _AuthorizedHttp
+        Credentials, InstalledAppFlow, MediaIoBaseUpload = _Credentials, _InstalledAppFlow, _MediaIoBaseUpload
+        # Assigned last: other threads treat build as the "loaded" flag
+        build = _build
+
+def _credentials_need_refresh(creds):
+    """Return True if the credentials are invalid or about to expire."""
+    if not creds.valid:
+        return True
+    if creds.expiry is None:
+        return False
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry - CREDENTIAL_REFRESH_MARGIN <= now
+
+class CredentialsUnavailable(Exception):
+    """Raised when there is no token that can be refreshed and someone has to authorize the app."""
+
+class CredentialStore:
+    """OAuth credentials shared by every worker process through one token file.
+
+    Each process keeps the parsed token in memory and only rereads the file
+    when its inode, size or modification time changed, so a token one
+    worker refreshed is picked up by the others without refreshing again.
+    Refreshing happens under an exclusive lock on a sibling .lock file, and
+    the new token is written to a temporary file and renamed over the old
+    one, so no worker ever reads a half-written token.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f'{path}.lock'
+        self.credentials = None
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _reload(self):
+        """Reread the token file if it changed since this process last read it."""
+        signature = self._file_signature()
+        if signature is not None and signature != self._signature:
+            try:
+                self.credentials = Credentials.from_authorized_user_file(self.path, SCOPES)
+            except ValueError as err:
+                raise CredentialsUnavailable(
+                    f"Unusable Google token in {self.path} ({err}); run `python site.py authorize`") from err
+            self._signature = signature
+        return self.credentials
+
+    @contextmanager
+    def _file_lock(self):
+        """Hold the cross-process token lock; callers must hold self._lock."""
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self):
+        """Return valid credentials, refreshing them only if no other worker already has."""
+        creds = self.credentials
+        if creds is not None and not _credentials_need_refresh(creds):
+            return creds
+
+        load_google_clients()
+        with self._lock, timed_span('credentials'):
+            creds = self._reload()
+            if creds is not None and not _credentials_need_refresh(creds):
+                return creds
+            with self._file_lock():
+                # Another worker may have refreshed while we waited for the lock
+                creds = self._reload()
+                if creds is None or _credentials_need_refresh(creds):
+                    creds = self._refresh(creds)
+        return creds
+
+    def _refresh(self, creds):
+        if creds is None or not creds.refresh_token:
+            raise CredentialsUnavailable(
+                f"No refreshable Google token in {self.path}; run `python site.py authorize`")
+        try:
+            creds.refresh(Request())
+        except RefreshError as err:
+            raise CredentialsUnavailable(
+                f"Could not refresh the Google token in {self.path} ({err}); run `python site.py authorize`") from err
+        logger.info("Refreshed the Google token in %s", self.path)
+        self._save(creds)
+        return creds
+
+    def _save(self, creds):
+        """Atomically replace the token file; callers must hold the file lock."""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.token-')
+        try:
+            with os.fdopen(fd, 'w') as token_file:
+                token_file.write(creds.to_json())
+                token_file.flush()
+                os.fsync(token_file.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.credentials = creds
+        self._signature = self._file_signature()
+
+    def authorize(self, client_secrets_file=CLIENT_SECRETS_FILE):
+        """Run the interactive OAuth flow and store its token. Never called on a request."""
+        load_google_clients()
+        flow = InstalledAppFlow.from_client_secrets_file(client_secrets_file, SCOPES)
+        creds = flow.run_local_server(port=0)
+        with self._lock, self._file_lock():
+            self._save(creds)
+        return creds
+
+credential_store = CredentialStore(TOKEN_FILE)
+
+def get_google_credentials():
+    """Get or refresh Google API credentials.
+
+    Raises CredentialsUnavailable instead of starting an interactive login
+    when the token is missing or cannot be refreshed.
+    """
+    return credential_store.get()
+
+def get_google_service(api_name, api_version):
+    """Return a reusable API client for the calling thread.
+
+    Each thread keeps its own client and keep-alive connection pool, all
+    sharing the process-wide credentials. Discovery documents are loaded
+    from the copies bundled with googleapiclient instead of fetched.
+    """
+    load_google_clients()
+    owner = google_http_factory or get_google_credentials()
+    services = getattr(_service_cache, 'services', None)
+    if services is None:
+        services = _service_cache.services = {}
+
+    cached = services.get((api_name, api_version))
+    if cached is not None and cached[0] is owner:
+        return cached[1]
+
+    if google_http_factory is not None:
+        http = google_http_factory()
+    else:
+        http = AuthorizedHttp(owner, http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT))
+    service = build(api_name, api_version, http=http, cache_discovery=False, static_discovery=True)
+    services[(api_name, api_version)] = (owner, service)
+    return service
+
+class TokenBucket:
+    """Thread-safe token bucket that blocks callers until tokens are available.
+
+    The burst capacity defaults to a tenth of the per-minute quota, and it
+    is taken out of the refill rate, so that no 60-second window (a full
+    bucket plus a minute of refills) ever allows more than the quota.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.capacity = capacity if capacity is not None else max(1, rate_per_minute // 10)
+        self.rate = max(1, rate_per_minute - self.capacity) / 60.0
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if enough have accumulated.
+
+        Returns 0 on success, otherwise the seconds until they will have.
+        """
+        tokens = min(tokens, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """Take tokens from the bucket, sleeping until enough have accumulated.
+
+        Returns True if the caller had to wait.
+        """
+        waited = False
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return waited
+            waited = True
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+        """Like acquire, but yields to the event loop while waiting."""
+        # Already loaded by whatever runs the loop; the module global is only set by get_async_loop()
+        import asyncio
+        waited = False
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return waited
+            waited = True
+            await asyncio.sleep(wait)
+
+def _process_budget(calls_per_minute):
+    return max(1, calls_per_minute // GOOGLE_API_PROCESSES)
+
+_google_api_buckets = {
+    'sheets': (TokenBucket(_process_budget(SHEETS_USER_CALLS_PER_MINUTE)),
+               TokenBucket(_process_budget(SHEETS_PROJECT_CALLS_PER_MINUTE))),
+    'drive': (TokenBucket(_process_budget(DRIVE_USER_CALLS_PER_MINUTE)),
+              TokenBucket(_process_budget(DRIVE_PROJECT_CALLS_PER_MINUTE))),
+}
+_google_api_slots = threading.BoundedSemaphore(GOOGLE_API_MAX_CONCURRENCY)
+
+def _is_retryable(err, idempotent=True):
+    """Return True for quota and transient server errors worth retrying.
+
+    Connection resets, timeouts and DNS failures are only retried for
+    idempotent calls: a copy or upload may have gone through before the
+    connection was lost, and repeating it would create a second file.
+    """
+    if not isinstance(err, HttpError):
+        return idempotent
+    if err.resp.status in RETRYABLE_STATUSES:
+        return True
+    if err.resp.status == 403:
+        return any(detail.get('reason') in RETRYABLE_REASONS
+                   for detail in (err.error_details or []) if isinstance(detail, dict))
+    return False
+
+def _backoff_delay(err, attempt):
+    """Exponential backoff with full jitter, honouring Retry-After when Google sends one."""
+    delay = random.uniform(0, min(GOOGLE_API_BACKOFF_MAX, GOOGLE_API_BACKOFF_BASE * 2 ** attempt))
+    if isinstance(err, HttpError):
+        retry_after = err.resp.get('retry-after')
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+    return delay
+
+def execute_google_request(http_request, api, idempotent=True):
+    """Execute a googleapiclient request through the shared scheduler.
+
+    Every Drive and Sheets call goes through here so that, across all
+    threads, calls stay within the per-user and per-project quotas of
+    their API and at most GOOGLE_API_MAX_CONCURRENCY are in flight.
+    Rate-limit and transient server errors are retried with backoff, and
+    network errors too unless the call is not idempotent; the last error is
+    raised once the retries are used up.
+    """
+    for attempt in range(GOOGLE_API_MAX_RETRIES + 1):
+        throttled = False
+        for bucket in _google_api_buckets[api]:
+            throttled = bucket.acquire() or throttled
+        if throttled:
+            metrics.inc('gsheet_google_api_throttled_total', api=api)
+
+        metrics.inc('gsheet_google_api_calls_total', api=api)
+        metrics.inc('gsheet_google_api_bytes_sent_total', len(http_request.body or ''), api=api)
+        with _google_api_slots:
+            try:
+                return http_request.execute()
+            except (HttpError, OSError, httplib2.HttpLib2Error) as err:
+                if attempt == GOOGLE_API_MAX_RETRIES or not _is_retryable(err, idempotent):
+                    metrics.inc('gsheet_google_api_failed_total', api=api)
+                    raise
+                error = err
+
+        metrics.inc('gsheet_google_api_retried_total', api=api)
+        delay = _backoff_delay(error, attempt)
+        logger.warning("Retrying %s call in %.1fs after error: %s", api, delay, error)
+        time.sleep(delay)
+
+def get_google_api_stats():
+    return {
+        counter: metrics.counter_total(f'gsheet_google_api_{counter}_total')
+        for counter in ('calls', 'throttled', 'retried', 'failed')
+    }
+
+# Point-buy rules
+POINT_BUY_MIN_SCORE = 6
+POINT_BUY_MAX_SCORE = 18
+POINT_BUY_BUDGET = 35
+ABILITY_COUNT = 6
+
+def _point_buy_cost(score):
+    # This formula calculates the point cost for a given ability score based on a custom polynomial equation.
+    return round(0.01515 * score ** 3 - 0.4196 * score ** 2 + 4.739 * score - 18.701)
+
+# Integer cost of every legal score, evaluated once at import
+POINT_BUY_COSTS = {score: _point_buy_cost(score) for score in range(POINT_BUY_MIN_SCORE, POINT_BUY_MAX_SCORE + 1)}
+
+def calculate_point_buy(scores):
+    try:
+        individual_costs = [POINT_BUY_COSTS[score] for score in scores]
+    except (KeyError, TypeError):
+        return {'is_valid': False, 'total': 0, 'individual_costs': []}
+    total = sum(individual_costs)
+    return {
+        'is_valid': total <= POINT_BUY_BUDGET,
+        'total': total,
+        'individual_costs': individual_costs
+    }
+
+@functools.lru_cache(maxsize=None)
+def _point_buy_array_index():
+    """Every distinct ability array (highest score first) ordered by total cost.
+
+    Returns (totals, arrays) where totals is sorted ascending so the arrays
+    within a budget are a prefix found by bisection.
+    """
+    scores = range(POINT_BUY_MAX_SCORE, POINT_BUY_MIN_SCORE - 1, -1)
+    priced = sorted(
+        (sum(POINT_BUY_COSTS[score] for score in array), array)
+        for array in combinations_with_replacement(scores, ABILITY_COUNT)
+    )
+    return [total for total, _ in priced], [array for _, array in priced]
+
+def legal_point_buy_arrays(budget, limit=None):
+    """Return (count, arrays) for ability arrays costing at most budget, most expensive first."""
+    totals, arrays = _point_buy_array_index()
+    end = bisect.bisect_right(totals, budget)
+    start = 0 if limit is None else max(0, end - limit)
+    return end, [
+        {'scores': list(arrays[index]), 'total': totals[index]}
+        for index in range(end - 1, start - 1, -1)
+    ]
+
+def process_request(form_data, progress=None):
+    """Create a character's sheet and return its ID, or None if copying failed.
+
+    progress, if given, is called as progress(stage, **fields) after each
+    step: 'copied', 'metadata' and 'written'.
+    """
+    if LOCAL_RENDER:
+        return process_request_local(form_data, progress)
+    character_name = form_data.get('character_name')
+    class_string = build_class_string(form_data)
+    new_sheet_id = claim_template_copy(character_name)
+    if new_sheet_id:
+        if progress is not None:
+            progress('copied', sheet_id=new_sheet_id)
+        failed_ranges = update_character_sheet(character_name, class_string, form_data, new_sheet_id, progress)
+        if failed_ranges:
+            logger.error("Failed to write cells: %s", failed_ranges)
+    else:
+        logger.error("Failed to copy the sheet.")
+        return None
+    return new_sheet_id
+
+def build_class_string(form_data):
+    class_string = extract_primary_class_data(form_data)
+    multiclass_data = extract_multiclass_data(form_data)
+    if multiclass_data:
+        class_string += f", {multiclass_data}"
+    return class_string
+
+def extract_primary_class_data(form_data):
+    class_data = form_data.get('class_data', [])
+    if class_data:
+        primary = class_data[0]
+        character_class = primary.get('class')
+        character_level = primary.get('level')
+        character_subclass = primary.get('subclass')
+
+        if character_class:
+            if character_subclass:
+                primary_class_data = f"{character_subclass} {character_class} {character_level}"
+            else:
+                primary_class_data = f"{character_class} {character_level}"
+            logger.debug("Added primary class: %s", primary_class_data)
+            return primary_class_data
+    logger.debug("No primary class provided")
+    return ""
+
+def extract_multiclass_data(form_data):
+    class_data = form_data.get('class_data', [])
+    if len(class_data) > 1:
+        multiclass_entries = class_data[1:]
+        class_string = ", ".join([
+            f"{entry['subclass']} {entry['class']} {entry['level']}" if entry.get('subclass') else f"{entry['class']} {entry['level']}"
+            for entry in multiclass_entries
+        ])
+        logger.debug("Generated multiclass string: %s", class_string)
+        return class_string
+    return ""
+
+def copy_entire_sheet(spreadsheet_id, new_spreadsheet_title):
+    try:
+        service = get_google_service('drive', 'v3')
+        # Copy the entire spreadsheet
+        with timed_span('drive_copy'):
+            copied_sheet = execute_google_request(service.files().copy(
+                fileId=spreadsheet_id,
+                body={'name': new_spreadsheet_title}
+            ), 'drive', idempotent=False)
+        logger.info("Copied sheet ID: %s", copied_sheet['id'])
+        return copied_sheet['id']
+    except HttpError as err:
+        logger.error("An error occurred: %s", err)
+        return None
+
+def rename_sheet(spreadsheet_id, new_spreadsheet_title):
+    try:
+        service = get_google_service('drive', 'v3')
+        execute_google_request(service.files().update(
+            fileId=spreadsheet_id,
+            body={'name': new_spreadsheet_title}
+        ), 'drive')
+        return True
+    except HttpError as err:
+        logger.error("An error occurred while renaming %s: %s", spreadsheet_id, err)
+        return False
+
+def trash_sheet(spreadsheet_id):
+    """Move a sheet to the Drive trash; returns True once it is gone."""
+    try:
+        service = get_google_service('drive', 'v3')
+        execute_google_request(service.files().update(
+            fileId=spreadsheet_id,
+            body={'trashed': True}
+        ), 'drive')
+        return True
+    except HttpError as err:
+        if err.resp.status == 404:
+            return True
+        logger.error("An error occurred while trashing %s: %s", spreadsheet_id, err)
+        return False
+
+# Ready copies live in the SQLite database, shared by every worker process
+_template_pool_lock = threading.Lock()
+_template_pool_refilling = False
+
+def take_pooled_copy(template_version):
+    """Take the oldest ready copy of this template version out of the pool, or return None.
+
+    The claim is a single IMMEDIATE transaction, so worker processes
+    sharing the database never hand out the same copy twice. Copies of an
+    older version are never handed out; the refill trashes them.
+    """
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        row = db.execute(
+            'SELECT sheet_id FROM template_pool WHERE template_id = ? AND template_version = ? '
+            'ORDER BY created_at LIMIT 1', (TEMPLATE_SPREADSHEET_ID, template_version)).fetchone()
+        if row is not None:
+            db.execute('DELETE FROM template_pool WHERE sheet_id = ?', (row['sheet_id'],))
+        db.execute(
+            'INSERT INTO template_pool_stats (counter, value) VALUES (?, 1) '
+            'ON CONFLICT (counter) DO UPDATE SET value = value + 1',
+            ('hits' if row is not None else 'misses',))
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    refill_template_pool(template_version)
+    return row['sheet_id'] if row is not None else None
+
+def count_pooled_copies(template_version):
+    return get_db().execute('SELECT COUNT(*) FROM template_pool WHERE template_id = ? AND template_version = ?',
+                            (TEMPLATE_SPREADSHEET_ID, template_version)).fetchone()[0]
+
+def discard_stale_pooled_copies(template_version):
+    """Trash the ready copies made from another template or an older version of this one.
+
+    A copy is only forgotten once Drive has trashed it, so none is left
+    behind untracked.
+    """
+    stale = [row['sheet_id'] for row in get_db().execute(
+        'SELECT sheet_id FROM template_pool WHERE template_id != ? OR template_version != ?',
+        (TEMPLATE_SPREADSHEET_ID, template_version))]
+    discarded = 0
+    for sheet_id in stale:
+        if trash_sheet(sheet_id):
+            get_db().execute('DELETE FROM template_pool WHERE sheet_id = ?', (sheet_id,))
+            discarded += 1
+    if stale:
+        logger.warning("Trashed %d of %d pooled copies of an old template", discarded, len(stale))
+
+def claim_template_copy(character_name):
+    """Return a template copy titled character_name, using a pooled copy if one is ready."""
+    if TEMPLATE_POOL_SIZE <= 0:
+        return copy_entire_sheet(TEMPLATE_SPREADSHEET_ID, character_name)
+
+    try:
+        # A copy of an older version would be filled using the current layout
+        template_version = get_template_layout()['version']
+    except HttpError as err:
+        logger.error("An error occurred: %s", err)
+        return copy_entire_sheet(TEMPLATE_SPREADSHEET_ID, character_name)
+    pooled_sheet_id = take_pooled_copy(template_version)
+    if pooled_sheet_id and rename_sheet(pooled_sheet_id, character_name):
+        return pooled_sheet_id
+    return copy_entire_sheet(TEMPLATE_SPREADSHEET_ID, character_name)
+
+def refill_template_pool(template_version=None):
+    """Start a background refill if the pool has dropped below its low-water mark.
+
+    Without template_version, as at startup, the refill always runs: it
+    looks the version up itself and first trashes any stale copies.
+    """
+    global _template_pool_refilling
+    with _template_pool_lock:
+        if _template_pool_refilling or (template_version is not None and
+                                        count_pooled_copies(template_version) >= TEMPLATE_POOL_LOW_WATER):
+            return
+        _template_pool_refilling = True
+    threading.Thread(target=_refill_template_pool, name='template-pool-refill', daemon=True).start()
+
+def _refill_template_pool():
+    global _template_pool_refilling
+    try:
+        template_version = get_template_layout()['version']
+        discard_stale_pooled_copies(template_version)
+        while count_pooled_copies(template_version) < TEMPLATE_POOL_SIZE:
+            new_sheet_id = copy_entire_sheet(TEMPLATE_SPREADSHEET_ID, POOLED_SHEET_TITLE)
+            if not new_sheet_id:
+                break
+            get_db().execute(
+                'INSERT INTO template_pool (sheet_id, template_id, template_version, created_at) '
+                'VALUES (?, ?, ?, ?)', (new_sheet_id, TEMPLATE_SPREADSHEET_ID, template_version, time.time()))
+    except Exception as err:
+        logger.exception("Error refilling template pool: %s", err)
+    finally:
+        with _template_pool_lock:
+            _template_pool_refilling = False
+
+@app.route('/template_pool', methods=['GET'])
+def template_pool_stats():
+    counters = dict(get_db().execute('SELECT counter, value FROM template_pool_stats').fetchall())
+    return jsonify({
+        'size': TEMPLATE_POOL_SIZE,
+        'low_water': TEMPLATE_POOL_LOW_WATER,
+        'ready': get_db().execute('SELECT COUNT(*) FROM template_pool').fetchone()[0],
+        'hits': counters.get('hits', 0),
+        'misses': counters.get('misses', 0),
+        'refilling': _template_pool_refilling,
+    })
+
+@app.route('/copy_sheet', methods=['POST'])
+def copy_sheet_route():
+    data = request.json
+    spreadsheet_id = data.get('spreadsheet_id')
+    new_spreadsheet_title = data.get('new_spreadsheet_title')
+    new_sheet_id = copy_entire_sheet(spreadsheet_id, new_spreadsheet_title)
+    if new_sheet_id:
+        return jsonify({'new_sheet_id': new_sheet_id}), 200
+    else:
+        return jsonify({'error': 'Failed to copy sheet'}), 500
+
+# Maximum number of ranges sent in a single values().batchUpdate call
+BATCH_WRITE_CHUNK_SIZE = 100
+
+ABILITY_NAMES = ('strength', 'dexterity', 'constitution', 'intelligence', 'wisdom', 'charisma')
+
+A1_CELL = re.compile(r'([A-Z]+)([0-9]+)')
+
+def a1_extent(cell_range):
+    """Return the (last row, last column) an A1 range such as 'D100:J100' reaches."""
+    rows, columns = [], []
+    for cell in cell_range.split(':'):
+        match = A1_CELL.fullmatch(cell)
+        if match is None:
+            raise ValueError(f"Invalid A1 cell: {cell!r}")
+        column = 0
+        for letter in match.group(1):
+            column = column * 26 + ord(letter) - ord('A') + 1
+        columns.append(column)
+        rows.append(int(match.group(2)))
+    return max(rows), max(columns)
+
+# Template cells written for each character
+SHEET_LAYOUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sheet_layout.json')
+
+def load_sheet_layout(path=SHEET_LAYOUT_FILE):
+    """Read the template's field-to-cell layout.
+
+    Raises ValueError if a required field is missing or any cell is not a
+    valid A1 cell or range, so a broken layout fails at startup rather
+    than on a character submission.
+    """
+    with open(path, encoding='utf-8') as layout_file:
+        raw = json.load(layout_file)
+    layout = {
+        'fields': dict(raw.get('fields', {})),
+        'classes': [dict(row) for row in raw.get('classes', [])],
+        'features': list(raw.get('features', [])),
+        'spells': {str(level): list(cells) for level, cells in raw.get('spells', {}).items()},
+        'spell_slots': {str(level): cell for level, cell in raw.get('spell_slots', {}).items()},
+    }
+    missing = [field for field in ('character_name', 'class_string') + ABILITY_NAMES
+               if field not in layout['fields']]
+    if missing:
+        raise ValueError(f"{path} has no cell for: {', '.join(missing)}")
+    for cell in layout_cells(layout):
+        a1_extent(cell)
+    return layout
+
+def layout_cells(layout):
+    """Every cell a layout refers to."""
+    yield from layout['fields'].values()
+    for row in layout['classes']:
+        yield from row.values()
+    yield from layout['features']
+    for cells in layout['spells'].values():
+        yield from cells
+    yield from layout['spell_slots'].values()
+
+class CompiledLayout:
+    """A sheet layout with every cell prefixed by its tab, ready to be written.
+
+    Cells listed in skip_cells are left out; later spells and features
+    move up into the remaining cells of their group.
+    """
+
+    def __init__(self, layout, sheet_name, skip_cells=frozenset()):
+        def ranges(cells):
+            return tuple(f'{sheet_name}!{cell}' for cell in cells if cell not in skip_cells)
+
+        self.sheet_name = sheet_name
+        self.fields = {field: f'{sheet_name}!{cell}'
+                       for field, cell in layout['fields'].items() if cell not in skip_cells}
+        self.classes = tuple({key: f'{sheet_name}!{cell}' for key, cell in row.items() if cell not in skip_cells}
+                             for row in layout['classes'])
+        self.features = ranges(layout['features'])
+        self.spells = {level: ranges(cells) for level, cells in layout['spells'].items()}
+        self.spell_slots = {level: f'{sheet_name}!{cell}'
+                            for level, cell in layout['spell_slots'].items() if cell not in skip_cells}
+
+@functools.lru_cache(maxsize=16)
+def compile_sheet_layout(sheet_name, skip_cells=frozenset()):
+    return CompiledLayout(SHEET_LAYOUT, sheet_name, skip_cells)
+
+def find_invalid_cells(row_count, column_count):
+    """Return the mapped cells that fall outside a tab's grid."""
+    invalid = set()
+    for cell in layout_cells(SHEET_LAYOUT):
+        row, column = a1_extent(cell)
+        if row > row_count or column > column_count:
+            invalid.add(cell)
+    if invalid:
+        logger.warning("Cells outside the template grid will not be written: %s", sorted(invalid))
+    return frozenset(invalid)
+
+SHEET_LAYOUT = load_sheet_layout()
+
+_template_layouts = {}
+_template_layout_lock = threading.Lock()
+
+def get_template_layout(template_id=TEMPLATE_SPREADSHEET_ID):
+    """Return the template's tab layout, cached per template ID and Drive version.
+
+    The layout holds the tab titles, sheet IDs and grid sizes along with
+    the mapped cells that do not fit the first tab. Every character sheet
+    is a copy of the template, so this replaces a metadata fetch per
+    character. The template's Drive version is re-checked at most every
+    TEMPLATE_LAYOUT_TTL seconds and the layout refetched when it changed.
+    """
+    layout = _template_layouts.get(template_id)
+    if layout is not None and time.monotonic() - layout['checked_at'] < TEMPLATE_LAYOUT_TTL:
+        return layout
+
+    with _template_layout_lock, timed_span('template_layout'):
+        layout = _template_layouts.get(template_id)
+        if layout is not None and time.monotonic() - layout['checked_at'] < TEMPLATE_LAYOUT_TTL:
+            return layout
+
+        drive = get_google_service('drive', 'v3')
+        try:
+            version = execute_google_request(
+                drive.files().get(fileId=template_id, fields='version'), 'drive')['version']
+            if layout is None or layout['version'] != version:
+                layout = _fetch_template_layout(template_id, version)
+                logger.info("Loaded layout of template %s at version %s", template_id, version)
+            else:
+                layout = dict(layout, checked_at=time.monotonic())
+        except HttpError:
+            if layout is None:
+                raise
+            # Keep using the last known layout until Google answers again
+            logger.warning("Could not check template %s; reusing cached layout", template_id)
+            layout = dict(layout, checked_at=time.monotonic())
+        _template_layouts[template_id] = layout
+    return layout
+
+# Only the tab properties the layout needs
+TEMPLATE_LAYOUT_FIELDS = 'sheets.properties(sheetId,title,index,gridProperties(rowCount,columnCount))'
+
+def _fetch_template_layout(template_id, version):
+    sheets = get_google_service('sheets', 'v4').spreadsheets()
+    metadata = execute_google_request(sheets.get(spreadsheetId=template_id, fields=TEMPLATE_LAYOUT_FIELDS), 'sheets')
+    return _parse_template_layout(template_id, version, metadata)
+
+def _parse_template_layout(template_id, version, metadata):
+    tabs = [
+        {
+            'sheet_id': tab['properties']['sheetId'],
+            'title': tab['properties']['title'],
+            'row_count': tab['properties'].get('gridProperties', {}).get('rowCount', 0),
+            'column_count': tab['properties'].get('gridProperties', {}).get('columnCount', 0),
+        }
+        for tab in sorted(metadata['sheets'], key=lambda tab: tab['properties'].get('index', 0))
+    ]
+    first_tab = tabs[0]
+    return {
+        'template_id': template_id,
+        'version': version,
+        'sheets': tabs,
+        'invalid_cells': find_invalid_cells(first_tab['row_count'], first_tab['column_count']),
+        'checked_at': time.monotonic(),
+    }
+
+def build_character_write_plan(layout, character_name, class_string, form_data, unplaced_spells=None):
+    """Collect every (A1 range, value) pair to be written for a character.
+
+    layout is a CompiledLayout, so this is a single pass over the form
+    data with no per-request range formatting. Spells whose level has no
+    free cell left are logged and, if a list is given, appended to
+    unplaced_spells so the caller can report them.
+    """
+    fields = layout.fields
+    values = {'character_name': character_name, 'class_string': class_string}
+    for ability in ABILITY_NAMES:
+        values[ability] = int(form_data.get(ability))
+    plan = [(fields[field], value) for field, value in values.items() if field in fields]
+
+    # One row per class entry, primary class first
+    for row, entry in zip(layout.classes, form_data.get('class_data', [])):
+        for key, cell_range in row.items():
+            if entry.get(key) not in (None, ''):
+                plan.append((cell_range, entry[key]))
+
+    plan.extend(zip(layout.features, form_data.get('features', [])))
+
+    # Spells arrive as "level: name" and fill their level's cells in order
+    spells = form_data.get('spells', [])
+    logger.debug("Raw spells: %s", spells)
+    unplaced = []
+    try:
+        used = {}
+        for spell in spells:
+            level, separator, spell_name = spell.partition(':')
+            level = level.strip()
+            cells = layout.spells.get(level, ()) if separator else ()
+            index = used.get(level, 0)
+            if index < len(cells):
+                plan.append((cells[index], spell_name.strip()))
+                used[level] = index + 1
+            elif spell.strip():
+                unplaced.append(spell.strip())
+    except Exception as err:
+        logger.exception("Error processing spells: %s", err)
+    if unplaced:
+        logger.warning("No cell for spells %s of %s", unplaced, character_name)
+        if unplaced_spells is not None:
+            unplaced_spells.extend(unplaced)
+
+    if layout.spell_slots:
+        plan.extend(spell_slot_cells(layout, form_data.get('class_data', [])))
+
+    return plan
+
+def spell_slot_cells(layout, class_data):
+    """Return the (A1 range, count) pairs for a character's spell slots, skipping empty ones."""
+    try:
+        result = spell_slot_calculator.slots(class_data)
+    except (ValueError, TypeError, AttributeError) as err:
+        logger.warning("Not writing spell slots: %s", err)
+        return []
+    counts = {str(level): count for level, count in enumerate(result['slots'].values(), start=1)}
+    if result['pact_magic']:
+        counts['pact_slots'] = result['pact_magic']['slots']
+        counts['pact_slot_level'] = result['pact_magic']['slot_level']
+    return [(layout.spell_slots[key], count) for key, count in counts.items() if count and key in layout.spell_slots]
+
+def get_character_layout():
+    """Return the CompiledLayout for character sheets, from the template's cached layout."""
+    # Copies share the template's tabs, so its cached layout names the tab to write
+    with timed_span('sheet_metadata'):
+        template_layout = get_template_layout()
+    return compile_template_layout(template_layout)
+
+def compile_template_layout(template_layout):
+    return compile_sheet_layout(template_layout['sheets'][0]['title'], template_layout['invalid_cells'])
+
+def update_character_sheet(character_name, class_string, form_data, spreadsheet_id, progress=None):
+    """Write all character cells in as few batchUpdate calls as possible.
+
+    Returns the list of ranges that could not be written. The cells that
+    were written are stored as the sheet's snapshot for later updates.
+    """
+    try:
+        service = get_google_service('sheets', 'v4')
+        sheet = service.spreadsheets()
+        layout = get_character_layout()
+    except HttpError as err:
+        logger.error("An error occurred: %s", err)
+        return None
+    if progress is not None:
+        progress('metadata')
+
+    unplaced_spells = []
+    plan = build_character_write_plan(layout, character_name, class_string, form_data, unplaced_spells)
+    failed_ranges = batch_update_values(sheet, spreadsheet_id, plan)
+    if progress is not None:
+        progress('written', failed_cells=len(failed_ranges), unplaced_spells=unplaced_spells)
+    save_sheet_snapshot(spreadsheet_id, character_name, apply_write_plan({}, plan, failed_ranges))
+    return failed_ranges
+
+def diff_write_plan(snapshot, plan):
+    """Return the (range, value) pairs that turn a snapshot's cells into the plan's.
+
+    Cells in the snapshot that the plan no longer fills (a dropped spell or
+    class) are cleared.
+    """
+    cells = dict(plan)
+    changes = [(cell_range, value) for cell_range, value in cells.items() if snapshot.get(cell_range) != value]
+    changes.extend((cell_range, '') for cell_range in snapshot if cell_range not in cells)
+    return changes
+
+def apply_write_plan(snapshot, plan, failed_ranges=()):
+    """Return the snapshot's cells after the plan's writes, leaving out failed ones."""
+    failed = set(failed_ranges)
+    cells = dict(snapshot)
+    for cell_range, value in plan:
+        if cell_range in failed:
+            continue
+        if value == '':
+            cells.pop(cell_range, None)
+        else:
+            cells[cell_range] = value
+    return cells
+
+# Local render mode: fill an exported copy of the template and upload it whole
+XLSX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+SPREADSHEET_MIME_TYPE = 'application/vnd.google-apps.spreadsheet'
+
+_template_export_lock = threading.Lock()
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def get_template_export(template_layout):
+    """Return the path of the template exported as .xlsx at the layout's Drive version.
+
+    Exports are cached on disk, so the template is downloaded once per
+    version however many workers use it; older versions are removed.
+    """
+    template_id = template_layout['template_id']
+    path = os.path.join(TEMPLATE_EXPORT_DIR, f"{template_id}-{template_layout['version']}.xlsx")
+    if os.path.exists(path):
+        return path
+
+    with _template_export_lock, timed_span('template_export'):
+        if os.path.exists(path):
+            return path
+        drive = get_google_service('drive', 'v3')
+        content = execute_google_request(drive.files().export(fileId=template_id, mimeType=XLSX_MIME_TYPE), 'drive')
+        os.makedirs(TEMPLATE_EXPORT_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=TEMPLATE_EXPORT_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as export_file:
+            export_file.write(content)
+        os.replace(tmp_path, path)
+        logger.info("Exported template %s at version %s", template_id, template_layout['version'])
+
+        for name in os.listdir(TEMPLATE_EXPORT_DIR):
+            old_path = os.path.join(TEMPLATE_EXPORT_DIR, name)
+            if name.startswith(f'{template_id}-') and name.endswith('.xlsx') and old_path != path:
+                try:
+                    os.remove(old_path)
+                except OSError as err:
+                    logger.warning("Could not remove old template export %s: %s", old_path, err)
+    return path
+
+def get_render_pool():
+    """Return the pool that fills workbooks, started on first use.
+
+    Workers run render_worker.fill_workbook, which imports only openpyxl.
+    They start from a fork server (or are spawned where there is none)
+    rather than being forked from this app, so they inherit neither its
+    memory nor its threads; the main script they re-import is serve.py.
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            if importlib.util.find_spec('openpyxl') is None:
+                raise RuntimeError("Local render mode (GSHEET_LOCAL_RENDER) needs the openpyxl package")
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['render_worker', 'openpyxl'])
+            else:
+                context = multiprocessing.get_context('spawn')
+            _render_pool = ProcessPoolExecutor(max_workers=LOCAL_RENDER_WORKERS, mp_context=context)
+    return _render_pool
+
+def upload_workbook(character_name, content):
+    """Create a Google Sheet from filled .xlsx bytes with one multipart Drive call; return its ID."""
+    drive = get_google_service('drive', 'v3')
+    media = MediaIoBaseUpload(io.BytesIO(content), mimetype=XLSX_MIME_TYPE, resumable=False)
+    with timed_span('drive_upload'):
+        created = execute_google_request(drive.files().create(
+            body={'name': character_name, 'mimeType': SPREADSHEET_MIME_TYPE},
+            media_body=media,
+            fields='id'
+        ), 'drive', idempotent=False)
+    logger.info("Uploaded sheet ID: %s", created['id'])
+    return created['id']
+
+def process_request_local(form_data, progress=None):
+    """process_request in local render mode: the filled template is uploaded in one call.
+
+    Returns the new sheet's ID, or None if Google could not be reached.
+    """
+    character_name = form_data.get('character_name')
+    class_string = build_class_string(form_data)
+    try:
+        with timed_span('sheet_metadata'):
+            template_layout = get_template_layout()
+        template_path = get_template_export(template_layout)
+    except HttpError as err:
+        logger.error("An error occurred: %s", err)
+        return None
+
+    unplaced_spells = []
+    plan = build_character_write_plan(compile_template_layout(template_layout), character_name, class_string,
+                                      form_data, unplaced_spells)
+    with timed_span('workbook_fill'):
+        content = get_render_pool().submit(render_worker.fill_workbook, template_path, plan).result()
+    try:
+        sheet_id = upload_workbook(character_name, content)
+    except HttpError as err:
+        logger.error("An error occurred: %s", err)
+        return None
+
+    if progress is not None:
+        # The upload covers every stage of the copy-and-write pipeline at once
+        progress('copied', sheet_id=sheet_id)
+        progress('metadata')
+        progress('written', failed_cells=0, unplaced_spells=unplaced_spells)
+    save_sheet_snapshot(sheet_id, character_name, apply_write_plan({}, plan))
+    return sheet_id
+
+class UnknownSheet(LookupError):
+    """Raised when asked to update a sheet this app did not create."""
+
+def update_existing_character(spreadsheet_id, form_data, allow_full_write=False):
+    """Bring an existing character sheet up to date with new form data.
+
+    Only cells that differ from the sheet's last-written snapshot are sent,
+    in one batch. Returns a summary of the update, or None if the sheet
+    could not be reached. A sheet without a snapshot raises UnknownSheet
+    unless allow_full_write is set, for a job finishing a sheet it copied
+    itself, in which case it is written in full. The template is never
+    written.
+    """
+    snapshot = load_sheet_snapshot(spreadsheet_id)
+    if spreadsheet_id == TEMPLATE_SPREADSHEET_ID or (snapshot is None and not allow_full_write):
+        raise UnknownSheet(f"No character sheet {spreadsheet_id}")
+
+    character_name = form_data.get('character_name')
+    class_string = build_class_string(form_data)
+    try:
+        service = get_google_service('sheets', 'v4')
+        sheet = service.spreadsheets()
+        layout = get_character_layout()
+    except HttpError as err:
+        logger.error("An error occurred: %s", err)
+        return None
+
+    unplaced_spells = []
+    plan = build_character_write_plan(layout, character_name, class_string, form_data, unplaced_spells)
+    if snapshot is None:
+        previous_name, cells, changes = None, {}, plan
+    else:
+        previous_name, cells = snapshot
+        changes = diff_write_plan(cells, plan)
+
+    failed_ranges = batch_update_values(sheet, spreadsheet_id, changes, chunk_size=max(len(changes), 1))
+    if character_name and character_name != previous_name:
+        rename_sheet(spreadsheet_id, character_name)
+    save_sheet_snapshot(spreadsheet_id, character_name, apply_write_plan(cells, changes, failed_ranges))
+    logger.info("Updated %s cells of %s (%s failed)", len(changes), spreadsheet_id, len(failed_ranges))
+    return {
+        'sheet_id': spreadsheet_id,
+        'character_name': character_name,
+        'updated_cells': len(changes) - len(failed_ranges),
+        'failed_ranges': failed_ranges,
+        'unplaced_spells': unplaced_spells,
+        'full_write': snapshot is None,
+    }
+
+def batch_update_values(sheet, spreadsheet_id, updates, chunk_size=BATCH_WRITE_CHUNK_SIZE):
+    """Send (range, value) pairs as chunked values().batchUpdate calls.
+
+    Returns the list of ranges whose chunk failed.
+    """
+    failed_ranges = []
+    for start in range(0, len(updates), chunk_size):
+        chunk = updates[start:start + chunk_size]
+        body = {
+            'valueInputOption': 'RAW',
+            'data': [{'range': cell_range, 'values': [[value]]} for cell_range, value in chunk]
+        }
+        try:
+            with timed_span('write_batch'):
+                execute_google_request(
+                    sheet.values().batchUpdate(spreadsheetId=spreadsheet_id, body=body), 'sheets')
+        except HttpError as err:
+            logger.error("An error occurred while updating the sheet: %s", err)
+            failed_ranges.extend(cell_range for cell_range, _ in chunk)
+    return failed_ranges
+
+# Asyncio Google transport. With GSHEET_ASYNC_GOOGLE=1 background character
+# jobs run as coroutines on one event loop thread instead of one worker
+# thread each, so a process can keep hundreds of characters in flight.
+
+DRIVE_API_URL = 'https://www.googleapis.com/drive/v3'
+SHEETS_API_URL = 'https://sheets.googleapis.com/v4'
+
+# Optional factory returning an async transport used instead of aiohttp
+# (used by benchmarks/fake_google.py)
+async_transport_factory = None
+
+# Imported by get_async_loop(); asyncio alone is a sizeable share of import time
+asyncio = None
+_async_loop = None
+_async_client = None
+_async_loop_lock = threading.Lock()
+_template_layout_async_lock = None
+
+def get_async_loop():
+    """Start the event loop thread for async Google calls once, and return its loop."""
+    global asyncio, _async_loop
+    with _async_loop_lock:
+        if _async_loop is None:
+            import asyncio as _asyncio
+            asyncio = _asyncio
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='google-async', daemon=True).start()
+            _async_loop = loop
+    return _async_loop
+
+class AiohttpTransport:
+    """One pooled aiohttp session shared by every async Google call."""
+
+    def __init__(self, limit):
+        import aiohttp
+        self.errors = (aiohttp.ClientError,)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=limit, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=GOOGLE_HTTP_TIMEOUT))
+
+    async def request(self, method, url, params=None, data=None, headers=None):
+        """Send one request and return (status, headers, body)."""
+        async with self.session.request(method, url, params=params, data=data, headers=headers) as response:
+            return response.status, dict(response.headers), await response.read()
+
+class AsyncGoogleClient:
+    """Minimal asyncio Drive and Sheets client for the calls character creation makes.
+
+    Calls go through the same quota buckets, retry policy and metrics as
+    execute_google_request, with at most max_in_flight in flight at once.
+    Error responses are raised as googleapiclient's HttpError, so callers
+    handle them exactly like the synchronous client's.
+    """
+
+    def __init__(self, transport, authorize=True, max_in_flight=ASYNC_MAX_IN_FLIGHT):
+        self.transport = transport
+        self.authorize = authorize
+        self.slots = asyncio.Semaphore(max_in_flight)
+
+    async def _headers(self):
+        headers = {'Content-Type': 'application/json'}
+        if self.authorize:
+            creds = credential_store.credentials
+            if creds is None or _credentials_need_refresh(creds):
+                # Loading or refreshing blocks, so it happens off the loop
+                creds = await asyncio.to_thread(get_google_credentials)
+            headers['Authorization'] = f'Bearer {creds.token}'
+        return headers
+
+    async def call(self, api, method, url, params=None, body=None, idempotent=True):
+        """Send one Drive or Sheets request and return its decoded JSON response."""
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        for attempt in range(GOOGLE_API_MAX_RETRIES + 1):
+            throttled = False
+            for bucket in _google_api_buckets[api]:
+                throttled = await bucket.acquire_async() or throttled
+            if throttled:
+                metrics.inc('gsheet_google_api_throttled_total', api=api)
+
+            metrics.inc('gsheet_google_api_calls_total', api=api)
+            metrics.inc('gsheet_google_api_bytes_sent_total', len(data or b''), api=api)
+            async with self.slots:
+                try:
+                    status, headers, content = await self.transport.request(
+                        method, url, params=params, data=data, headers=await self._headers())
+                    if status < 300:
+                        return json.loads(content) if content else {}
+                    raise HttpError(httplib2.Response(dict(headers, status=status)), content, uri=url)
+                except (HttpError, OSError, asyncio.TimeoutError, *getattr(self.transport, 'errors', ())) as err:
+                    if attempt == GOOGLE_API_MAX_RETRIES or not _is_retryable(err, idempotent):
+                        metrics.inc('gsheet_google_api_failed_total', api=api)
+                        raise
+                    error = err
+
+            metrics.inc('gsheet_google_api_retried_total', api=api)
+            delay = _backoff_delay(error, attempt)
+            logger.warning("Retrying %s call in %.1fs after error: %s", api, delay, error)
+            await asyncio.sleep(delay)
+
+    async def copy_file(self, file_id, name):
+        return await self.call('drive', 'POST', f'{DRIVE_API_URL}/files/{file_id}/copy', body={'name': name},
+                               idempotent=False)
+
+    async def get_file(self, file_id, fields):
+        return await self.call('drive', 'GET', f'{DRIVE_API_URL}/files/{file_id}', params={'fields': fields})
+
+    async def rename_file(self, file_id, name):
+        return await self.call('drive', 'PATCH', f'{DRIVE_API_URL}/files/{file_id}', body={'name': name})
+
+    async def get_spreadsheet(self, spreadsheet_id, fields):
+        return await self.call('sheets', 'GET', f'{SHEETS_API_URL}/spreadsheets/{spreadsheet_id}',
+                               params={'fields': fields})
+
+    async def batch_update_values(self, spreadsheet_id, body):
+        return await self.call('sheets', 'POST', f'{SHEETS_API_URL}/spreadsheets/{spreadsheet_id}/values:batchUpdate',
+                               body=body)
+
+def get_async_google_client():
+    """Return the shared AsyncGoogleClient; call from the async loop."""
+    global _async_client
+    if _async_client is None:
+        # HttpError responses are built with httplib2
+        load_google_clients()
+        if async_transport_factory is not None:
+            _async_client = AsyncGoogleClient(async_transport_factory(), authorize=False)
+        else:
+            _async_client = AsyncGoogleClient(AiohttpTransport(ASYNC_MAX_IN_FLIGHT))
+    return _async_client
+
+async def copy_entire_sheet_async(spreadsheet_id, new_spreadsheet_title):
+    try:
+        with timed_span('drive_copy'):
+            copied_sheet = await get_async_google_client().copy_file(spreadsheet_id, new_spreadsheet_title)
+        logger.info("Copied sheet ID: %s", copied_sheet['id'])
+        return copied_sheet['id']
+    except HttpError as err:
+        logger.error("An error occurred: %s", err)
+        return None
+
+async def rename_sheet_async(spreadsheet_id, new_spreadsheet_title):
+    try:
+        await get_async_google_client().rename_file(spreadsheet_id, new_spreadsheet_title)
+        return True
+    except HttpError as err:
+        logger.error("An error occurred while renaming %s: %s", spreadsheet_id, err)
+        return False
+
+async def claim_template_copy_async(character_name):
+    if TEMPLATE_POOL_SIZE <= 0:
+        return await copy_entire_sheet_async(TEMPLATE_SPREADSHEET_ID, character_name)
+
+    try:
+        template_version = (await get_template_layout_async())['version']
+    except HttpError as err:
+        logger.error("An error occurred: %s", err)
+        return await copy_entire_sheet_async(TEMPLATE_SPREADSHEET_ID, character_name)
+    pooled_sheet_id = await asyncio.to_thread(take_pooled_copy, template_version)
+    if pooled_sheet_id and await rename_sheet_async(pooled_sheet_id, character_name):
+        return pooled_sheet_id
+    return await copy_entire_sheet_async(TEMPLATE_SPREADSHEET_ID, character_name)
+
+async def get_template_layout_async(template_id=TEMPLATE_SPREADSHEET_ID):
+    """get_template_layout for the async loop, sharing its cache."""
+    global _template_layout_async_lock
+    layout = _template_layouts.get(template_id)
+    if layout is not None and time.monotonic() - layout['checked_at'] < TEMPLATE_LAYOUT_TTL:
+        return layout
+
+    if _template_layout_async_lock is None:
+        _template_layout_async_lock = asyncio.Lock()
+    async with _template_layout_async_lock:
+        layout = _template_layouts.get(template_id)
+        if layout is not None and time.monotonic() - layout['checked_at'] < TEMPLATE_LAYOUT_TTL:
+            return layout
+
+        client = get_async_google_client()
+        try:
+            version = (await client.get_file(template_id, 'version'))['version']
+            if layout is None or layout['version'] != version:
+                metadata = await client.get_spreadsheet(template_id, TEMPLATE_LAYOUT_FIELDS)
+                layout = _parse_template_layout(template_id, version, metadata)
+                logger.info("Loaded layout of template %s at version %s", template_id, version)
+            else:
+                layout = dict(layout, checked_at=time.monotonic())
+        except HttpError:
+            if layout is None:
+                raise
+            logger.warning("Could not check template %s; reusing cached layout", template_id)
+            layout = dict(layout, checked_at=time.monotonic())
+        _template_layouts[template_id] = layout
+    return layout
+
+async def batch_update_values_async(spreadsheet_id, updates, chunk_size=BATCH_WRITE_CHUNK_SIZE):
+    """batch_update_values for the async loop; chunks are sent concurrently."""
+    async def send(chunk):
+        body = {
+            'valueInputOption': 'RAW',
+            'data': [{'range': cell_range, 'values': [[value]]} for cell_range, value in chunk]
+        }
+        try:
+            with timed_span('write_batch'):
+                await get_async_google_client().batch_update_values(spreadsheet_id, body)
+            return []
+        except HttpError as err:
+            logger.error("An error occurred while updating the sheet: %s", err)
+            return [cell_range for cell_range, _ in chunk]
+
+    chunks = [updates[start:start + chunk_size] for start in range(0, len(updates), chunk_size)]
+    results = await asyncio.gather(*(send(chunk) for chunk in chunks))
+    return [cell_range for failed in results for cell_range in failed]
+
+async def update_character_sheet_async(character_name, class_string, form_data, spreadsheet_id, progress=None):
+    try:
+        with timed_span('sheet_metadata'):
+            template_layout = await get_template_layout_async()
+    except HttpError as err:
+        logger.error("An error occurred: %s", err)
+        return None
+    if progress is not None:
+        progress('metadata')
+
+    layout = compile_template_layout(template_layout)
+    unplaced_spells = []
+    plan = build_character_write_plan(layout, character_name, class_string, form_data, unplaced_spells)
+    failed_ranges = await batch_update_values_async(spreadsheet_id, plan)
+    if progress is not None:
+        progress('written', failed_cells=len(failed_ranges), unplaced_spells=unplaced_spells)
+    await asyncio.to_thread(save_sheet_snapshot, spreadsheet_id, character_name,
+                            apply_write_plan({}, plan, failed_ranges))
+    return failed_ranges
+
+async def process_request_async(form_data, progress=None):
+    """process_request on the asyncio transport."""
+    character_name = form_data.get('character_name')
+    class_string = build_class_string(form_data)
+    new_sheet_id = await claim_template_copy_async(character_name)
+    if not new_sheet_id:
+        logger.error("Failed to copy the sheet.")
+        return None
+    if progress is not None:
+        progress('copied', sheet_id=new_sheet_id)
+    failed_ranges = await update_character_sheet_async(character_name, class_string, form_data, new_sheet_id,
+                                                       progress)
+    if failed_ranges:
+        logger.error("Failed to write cells: %s", failed_ranges)
+    return new_sheet_id
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe('gsheet_http_request_duration_seconds', time.perf_counter() - started,
+                        route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/google_api_stats', methods=['GET'])
+def google_api_stats():
+    return jsonify(get_google_api_stats())
+
+@app.route('/validate_points', methods=['POST'])
+def validate_points():
+    scores = request.json.get('scores', [])
+    if not isinstance(scores, list) or not all(isinstance(score, int) for score in scores):
+        return jsonify({'error': 'Invalid input. Scores must be a list of integers.'}), 400
+    result = calculate_point_buy(scores)
+    return jsonify(result)
+
+@app.route('/validate_points/batch', methods=['POST'])
+def validate_points_batch():
+    """Validate many score arrays in one request."""
+    arrays = request.json.get('arrays', [])
+    if not isinstance(arrays, list) or not all(
+            isinstance(scores, list) and all(isinstance(score, int) for score in scores) for scores in arrays):
+        return jsonify({'error': 'Invalid input. arrays must be a list of lists of integers.'}), 400
+    return jsonify({'results': [calculate_point_buy(scores) for scores in arrays]})
+
+@app.route('/point_buy_arrays', methods=['GET'])
+def point_buy_arrays():
+    """List the distinct ability arrays that fit within a point budget."""
+    budget = request.args.get('budget', POINT_BUY_BUDGET, type=int)
+    limit = request.args.get('limit', 100, type=int)
+    count, arrays = legal_point_buy_arrays(budget, limit=max(0, limit))
+    return jsonify({'budget': budget, 'count': count, 'arrays': arrays})
+
+@app.route('/get_subclasses/<string:class_name>', methods=['GET'])
+def get_subclasses(class_name):
+    """Return subclasses for a specific class."""
+    subclasses = dnd_subclasses.get(class_name, [])
+    subclass_level = dnd_subclass_levels.get(class_name, 0)
+    return jsonify({'subclasses': subclasses, 'level_required': subclass_level})
+
+@app.route('/get_spells/<string:class_name>', methods=['GET'])
+def get_spells_route(class_name):
+    return get_spells(class_name)
+
+def get_spells(class_name):
+    """Endpoint to get spells for a given class."""
+    spells = dnd_spells.get(class_name, {})
+    # Example response structure
+    response = {
+        "level_required": 1,  # Adjust as needed per class
+        "spells": spells
+    }
+    return jsonify(response)
+
+def build_rules_payload():
+    """Serialize all rules data once and precompress it.
+
+    Returns (version, variants) where variants maps a content encoding
+    ('identity', 'gzip' and, if available, 'br') to the encoded body. The
+    version is a hash of the data, so it changes whenever the rules do.
+    """
+    rules = {
+        'classes': dnd_classes,
+        'subclasses': dnd_subclasses,
+        'subclass_levels': dnd_subclass_levels,
+        'spells': dnd_spells,
+        'caster_progression': caster_progression,
+    }
+    serialized = json.dumps(rules, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    version = hashlib.sha256(serialized.encode('utf-8')).hexdigest()[:16]
+    rules['version'] = version
+    body = json.dumps(rules, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return version, precompress(body)
+
+def precompress(body):
+    """Return the body in every content encoding we can serve."""
+    variants = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(body, quality=11)
+    return variants
+
+def send_precompressed(variants, version, mimetype, cache_control):
+    """Serve the best precompressed variant the client accepts, honouring If-None-Match."""
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in variants and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+
+    # Each encoding is a different representation and gets its own strong ETag
+    etag = version if encoding == 'identity' else f'{version}-{encoding}'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(variants[encoding], mimetype=mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+RULES_VERSION, _rules_variants = build_rules_payload()
+
+@app.context_processor
+def inject_rules_version():
+    return {'rules_version': RULES_VERSION}
+
+@app.route('/rules', methods=['GET'])
+def rules():
+    """All rules data in one payload; revalidated on every use."""
+    return send_precompressed(_rules_variants, RULES_VERSION, 'application/json', 'no-cache')
+
+@app.route('/rules/<string:version>', methods=['GET'])
+def versioned_rules(version):
+    """All rules data at a fixed version, cacheable forever."""
+    if version != RULES_VERSION:
+        return redirect(f'/rules/{RULES_VERSION}')
+    return send_precompressed(_rules_variants, RULES_VERSION, 'application/json',
+                              'public, max-age=31536000, immutable')
+
+# Page CSS and JavaScript, served under content-hashed names
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets')
+
+def minify_css(source):
+    """Drop comments and the whitespace around CSS punctuation."""
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+    source = re.sub(r'\s+', ' ', source)
+    source = re.sub(r'\s*([{};,>])\s*', r'\1', source)
+    return re.sub(r':\s+', ':', source).replace(';}', '}').strip()
+
+def minify_js(source):
+    """Drop indentation, blank lines and whole-line comments.
+
+    Line breaks are kept, so no statement ever runs into the next one.
+    """
+    lines = (line.strip() for line in source.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+ASSET_MINIFIERS = {'.css': ('text/css', minify_css), '.js': ('text/javascript', minify_js)}
+
+def build_static_assets(directory=ASSETS_DIR):
+    """Minify, content-hash and precompress every CSS and JavaScript asset once.
+
+    Returns (urls, assets) where urls maps each source file name to its
+    hashed URL and assets maps each hashed file name to its
+    (version, mimetype, variants).
+    """
+    urls, assets = {}, {}
+    for name in sorted(os.listdir(directory)):
+        stem, extension = os.path.splitext(name)
+        if extension not in ASSET_MINIFIERS:
+            continue
+        mimetype, minify = ASSET_MINIFIERS[extension]
+        with open(os.path.join(directory, name), encoding='utf-8') as asset_file:
+            body = minify(asset_file.read()).encode('utf-8')
+        version = hashlib.sha256(body).hexdigest()[:16]
+        hashed_name = f'{stem}.{version}{extension}'
+        urls[name] = f'/assets/{hashed_name}'
+        assets[hashed_name] = (version, mimetype, precompress(body))
+    return urls, assets
+
+ASSET_URLS, _static_assets = build_static_assets()
+
+@app.route('/assets/<string:filename>', methods=['GET'])
+def static_asset(filename):
+    """A page asset; its name changes with its content, so it is cached forever."""
+    asset = _static_assets.get(filename)
+    if asset is None:
+        return Response(status=404)
+    version, mimetype, variants = asset
+    return send_precompressed(variants, version, mimetype, 'public, max-age=31536000, immutable')
+
+_index_pages = {}
+
+def index_page():
+    """The form page, rendered and compressed once per rules version and revalidated by ETag."""
+    page = _index_pages.get(RULES_VERSION)
+    if page is None:
+        body = render_template('index.html', classes=dnd_classes, subclasses=dnd_subclasses,
+                               assets=ASSET_URLS).encode('utf-8')
+        page = _index_pages[RULES_VERSION] = (hashlib.sha256(body).hexdigest()[:16], precompress(body))
+    version, variants = page
+    return send_precompressed(variants, version, 'text/html', 'no-cache')
+
+class SpellCatalog:
+    """Interned spell list with precomputed indexes by class and level.
+
+    Every distinct (level, name) pair gets one integer ID, assigned in
+    sorted order, so spells shared between classes are stored once and any
+    sorted set of IDs maps directly to sorted "Level N: Name" labels.
+    """
+
+    def __init__(self, spells_by_class):
+        entries = sorted({
+            (int(level), sys.intern(name))
+            for class_spells in spells_by_class.values()
+            for level, names in class_spells.items()
+            for name in names
+        })
+        spell_ids = {entry: spell_id for spell_id, entry in enumerate(entries)}
+
+        self.spells = tuple(entries)
+        self.labels = tuple(f"Level {level}: {name}" for level, name in entries)
+        self.by_class = {
+            class_name: tuple(sorted({
+                spell_ids[(int(level), name)]
+                for level, names in class_spells.items()
+                for name in names
+            }))
+            for class_name, class_spells in spells_by_class.items()
+        }
+        by_level = {}
+        for spell_id, (level, _) in enumerate(entries):
+            by_level.setdefault(level, []).append(spell_id)
+        self.by_level = {level: tuple(ids) for level, ids in by_level.items()}
+        # Lower-cased names in order, for prefix search by bisection
+        self._search_keys = sorted((name.lower(), spell_id) for spell_id, (_, name) in enumerate(entries))
+        self._combined = functools.lru_cache(maxsize=1024)(self._combine_classes)
+
+    def _normalize_classes(self, class_names):
+        """Known classes only, deduplicated and ordered, for use as a cache key."""
+        return tuple(sorted(set(class_name for class_name in class_names if class_name in self.by_class)))
+
+    def _combine_classes(self, class_key):
+        if len(class_key) == 1:
+            return self.by_class[class_key[0]]
+        return tuple(sorted(set().union(*(self.by_class[class_name] for class_name in class_key))))
+
+    def spell_ids_for_classes(self, class_names):
+        """Sorted IDs of every spell available to any of the given classes."""
+        return self._combined(self._normalize_classes(class_names))
+
+    def combined_labels(self, class_names):
+        labels = self.labels
+        return [labels[spell_id] for spell_id in self.spell_ids_for_classes(class_names)]
+
+    def search(self, prefix, class_names=None, limit=None):
+        """Labels of spells whose name starts with prefix, optionally limited to some classes."""
+        prefix = prefix.lower()
+        allowed = set(self.spell_ids_for_classes(class_names)) if class_names else None
+        matches = []
+        start = bisect.bisect_left(self._search_keys, (prefix,))
+        for name, spell_id in self._search_keys[start:]:
+            if not name.startswith(prefix) or (limit is not None and len(matches) >= limit):
+                break
+            if allowed is None or spell_id in allowed:
+                matches.append(spell_id)
+        return [self.labels[spell_id] for spell_id in sorted(matches)]
+
+spell_catalog = SpellCatalog(dnd_spells)
+
+def get_combined_spells(class_names):
+    """Return combined spells for a list of classes."""
+    return spell_catalog.combined_labels(class_names)
+
+@app.route('/get_combined_spells', methods=['POST'])
+def get_combined_spells_route():
+    data = request.json
+    class_names = data.get('class_names', [])
+    if not isinstance(class_names, list) or not all(isinstance(cls, str) for cls in class_names):
+        return jsonify({'error': 'Invalid input. class_names must be a list of strings.'}), 400
+    spells = get_combined_spells(class_names)
+    return jsonify({'spells': spells})
+
+@app.route('/search_spells', methods=['GET'])
+def search_spells():
+    """Find spells by name prefix, optionally limited to the given classes (?class=Wizard&class=Bard)."""
+    prefix = request.args.get('prefix', '')
+    class_names = request.args.getlist('class')
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({'spells': spell_catalog.search(prefix, class_names, limit=max(0, limit))})
+
+@app.route('/spell_slots', methods=['POST'])
+def spell_slots():
+    """Spell slots for a character's classes; cheap enough to call on every level change."""
+    class_data = request.json.get('class_data', [])
+    if not isinstance(class_data, list) or not all(isinstance(entry, dict) for entry in class_data):
+        return jsonify({'error': 'Invalid input. class_data must be a list of objects.'}), 400
+    try:
+        return jsonify(spell_slot_calculator.slots(class_data))
+    except ValueError as err:
+        return jsonify({'error': str(err)}), 400
+
+_db_local = threading.local()
+
+def get_db():
+    """Return the calling thread's connection to the local SQLite database."""
+    db = getattr(_db_local, 'connection', None)
+    if db is None:
+        db = sqlite3.connect(DATABASE_FILE, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        # Accepted characters must survive a power cut, so sync every commit
+        db.execute('PRAGMA synchronous=FULL')
+        _db_local.connection = db
+    return db
+
+def init_db():
+    get_db().executescript('''
+        CREATE TABLE IF NOT EXISTS submissions (
+            key TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            job_id TEXT NOT NULL,
+            character_name TEXT,
+            sheet_id TEXT,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS submissions_job_id ON submissions (job_id);
+        CREATE INDEX IF NOT EXISTS submissions_created_at ON submissions (created_at);
+        CREATE TABLE IF NOT EXISTS sheet_snapshots (
+            sheet_id TEXT PRIMARY KEY,
+            character_name TEXT,
+            cells TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS outbox (
+            job_id TEXT PRIMARY KEY,
+            submission_key TEXT,
+            form_data TEXT NOT NULL,
+            status TEXT NOT NULL,
+            sheet_id TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            not_before REAL NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, not_before);
+        CREATE TABLE IF NOT EXISTS template_pool (
+            sheet_id TEXT PRIMARY KEY,
+            template_id TEXT NOT NULL,
+            template_version TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS template_pool_stats (
+            counter TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    ''')
+    if 'template_version' not in [row['name'] for row in get_db().execute('PRAGMA table_info(template_pool)')]:
+        # A pool filled before versions were recorded: its copies count as stale
+        get_db().execute("ALTER TABLE template_pool ADD COLUMN template_version TEXT NOT NULL DEFAULT ''")
+
+init_db()
+
+if TEMPLATE_POOL_SIZE > 0:
+    refill_template_pool()
+
+def load_sheet_snapshot(sheet_id):
+    """Return (character_name, {range: value}) last written to a sheet, or None."""
+    row = get_db().execute('SELECT character_name, cells FROM sheet_snapshots WHERE sheet_id = ?',
+                           (sheet_id,)).fetchone()
+    if row is None:
+        return None
+    return row['character_name'], json.loads(row['cells'])
+
+def save_sheet_snapshot(sheet_id, character_name, cells):
+    get_db().execute(
+        'INSERT OR REPLACE INTO sheet_snapshots (sheet_id, character_name, cells, updated_at) VALUES (?, ?, ?, ?)',
+        (sheet_id, character_name, json.dumps(cells, separators=(',', ':')), time.time()))
+
+def submission_key(form_data):
+    """Content hash of the normalized form data, used when no Idempotency-Key is sent."""
+    def normalize(value):
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [normalize(item) for item in value]
+        if isinstance(value, str):
+            return value.strip()
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            # The form sends scores as strings; API clients may send numbers
+            return str(value)
+        return value
+
+    canonical = json.dumps(normalize(form_data), sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return 'sha256:' + hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def claim_submission(key, job_id, form_data):
+    """Record a new submission in the outbox, or return the live one already stored under key.
+
+    Returns None when the submission was recorded and the caller should
+    start job_id, otherwise the existing submission as a dict. Both the
+    dedup row and the outbox entry are written in one transaction, so an
+    accepted character costs a single fsync. Expired submissions are
+    evicted first, and pending ones whose outbox entry is gone and that
+    are older than IDEMPOTENCY_PENDING_TIMEOUT are taken over.
+    """
+    now = time.time()
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute('DELETE FROM submissions WHERE created_at < ?', (now - IDEMPOTENCY_TTL,))
+        row = db.execute(
+            'SELECT submissions.*, outbox.status AS outbox_status FROM submissions '
+            'LEFT JOIN outbox ON outbox.job_id = submissions.job_id WHERE key = ?', (key,)).fetchone()
+        if row is not None and (row['status'] == 'done' or row['outbox_status'] in ('pending', 'running')
+                                or now - row['created_at'] < IDEMPOTENCY_PENDING_TIMEOUT):
+            db.execute('COMMIT')
+            return dict(row)
+        db.execute(
+            'INSERT OR REPLACE INTO submissions (key, status, job_id, character_name, sheet_id, created_at) '
+            'VALUES (?, ?, ?, ?, NULL, ?)',
+            (key, 'pending', job_id, form_data.get('character_name'), now))
+        # Leased to this process, which starts it straight away
+        db.execute(
+            'INSERT INTO outbox (job_id, submission_key, form_data, status, not_before, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (job_id, key, json.dumps(form_data), 'running', now + OUTBOX_LEASE, now, now))
+        db.execute('COMMIT')
+        return None
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+
+def complete_submission(key, sheet_id):
+    get_db().execute("UPDATE submissions SET status = 'done', sheet_id = ? WHERE key = ?", (sheet_id, key))
+
+def release_submission(key, job_id):
+    """Forget a submission that failed so that it can be retried."""
+    get_db().execute('DELETE FROM submissions WHERE key = ? AND job_id = ?', (key, job_id))
+
+def find_submission_by_job(job_id):
+    row = get_db().execute('SELECT * FROM submissions WHERE job_id = ?', (job_id,)).fetchone()
+    return dict(row) if row is not None else None
+
+def get_outbox_entry(job_id):
+    row = get_db().execute('SELECT * FROM outbox WHERE job_id = ?', (job_id,)).fetchone()
+    return dict(row) if row is not None else None
+
+def claim_outbox_entries(limit):
+    """Lease up to limit outbox entries that are due, oldest first.
+
+    Entries whose lease has run out belong to a worker that crashed or was
+    restarted, and are handed out again.
+    """
+    now = time.time()
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute("UPDATE outbox SET status = 'pending' WHERE status = 'running' AND not_before < ?", (now,))
+        rows = [dict(row) for row in db.execute(
+            "SELECT * FROM outbox WHERE status = 'pending' AND not_before <= ? ORDER BY created_at LIMIT ?",
+            (now, limit))]
+        db.executemany("UPDATE outbox SET status = 'running', not_before = ?, updated_at = ? WHERE job_id = ?",
+                       [(now + OUTBOX_LEASE, now, row['job_id']) for row in rows])
+        db.execute('COMMIT')
+        return rows
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+
+def renew_outbox_leases(job_ids):
+    """Extend the lease on entries this process is still working on."""
+    now = time.time()
+    get_db().executemany(
+        "UPDATE outbox SET not_before = ?, updated_at = ? WHERE job_id = ? AND status = 'running'",
+        [(now + OUTBOX_LEASE, now, job_id) for job_id in job_ids])
+
+def update_outbox_entry(job_id, **fields):
+    fields['updated_at'] = time.time()
+    assignments = ', '.join(f'{column} = ?' for column in fields)
+    get_db().execute(f'UPDATE outbox SET {assignments} WHERE job_id = ?', (*fields.values(), job_id))
+
+def compact_outbox():
+    """Delete finished outbox entries older than OUTBOX_RETENTION."""
+    cursor = get_db().execute("DELETE FROM outbox WHERE status IN ('done', 'failed') AND updated_at < ?",
+                              (time.time() - OUTBOX_RETENTION,))
+    if cursor.rowcount:
+        logger.info("Compacted %s finished outbox entries", cursor.rowcount)
+
+def _outbox_retry_delay(attempts):
+    return min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_DELAY * 2 ** (attempts - 1))
+
+class JobQueueFull(Exception):
+    """Raised when the background job queue has no room for another character."""
+
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='character-job')
+_jobs = OrderedDict()
+_job_events = {}
+_jobs_lock = threading.Lock()
+_jobs_changed = threading.Condition(_jobs_lock)
+_active_jobs = 0
+_outbox_wakeup = threading.Event()
+
+def submit_character_job(form_data, job_id=None, submission_key=None, sheet_id=None, attempts=0):
+    """Queue a character for background creation and return its job ID.
+
+    sheet_id and attempts resume an outbox entry whose earlier attempt
+    already copied the sheet or failed.
+    """
+    global _active_jobs
+    with _jobs_changed:
+        if _active_jobs >= JOB_QUEUE_LIMIT:
+            raise JobQueueFull(f"{_active_jobs} characters are already queued")
+        _active_jobs += 1
+        job_id = job_id or uuid.uuid4().hex
+        job = _jobs.setdefault(job_id, {
+            'job_id': job_id,
+            'character_name': form_data.get('character_name'),
+            'error': None,
+            'submitted_at': time.time(),
+        })
+        job.update(status='queued', stage='queued', sheet_id=sheet_id, attempts=attempts)
+        # A retry keeps the earlier events so open progress streams carry on
+        _job_events.setdefault(job_id, []).append(('queued', dict(job)))
+        _jobs_changed.notify_all()
+        _trim_job_history()
+    # Local rendering uploads once per character and gains nothing from the async transport
+    if ASYNC_GOOGLE and not LOCAL_RENDER:
+        loop = get_async_loop()
+        asyncio.run_coroutine_threadsafe(
+            _run_character_job_async(job_id, form_data, submission_key, sheet_id, attempts), loop)
+    else:
+        _job_executor.submit(_run_character_job, job_id, form_data, submission_key, sheet_id, attempts)
+    return job_id
+
+def _trim_job_history():
+    """Forget the oldest finished jobs once the history limit is exceeded."""
+    excess = len(_jobs) - JOB_HISTORY_LIMIT
+    if excess <= 0:
+        return
+    finished = [job_id for job_id, job in _jobs.items() if job['status'] in ('done', 'failed')]
+    for job_id in finished[:excess]:
+        del _jobs[job_id]
+        _job_events.pop(job_id, None)
+    _jobs_changed.notify_all()
+
+def _update_job(job_id, stage=None, **fields):
+    """Update a job and publish the change to its progress streams.
+
+    A status change is also a stage; stage names a step within 'running'.
+    """
+    with _jobs_changed:
+        job = _jobs.get(job_id)
+        if job is not None:
+            job.update(fields)
+            job['stage'] = stage or fields.get('status', job['stage'])
+            _job_events[job_id].append((job['stage'], dict(job)))
+            _jobs_changed.notify_all()
+
+def _job_progress(job_id, record_progress):
+    """Return (progress, outcome): a progress callback for one job attempt and the fields it reported."""
+    outcome = {}
+
+    def progress(stage, **fields):
+        outcome.update(fields)
+        # The copy is remembered so that a retry or replay never copies the template twice
+        record_progress(job_id, fields['sheet_id'] if stage == 'copied' else None)
+        _update_job(job_id, stage=stage, **fields)
+
+    return progress, outcome
+
+def _is_transient_job_error(err):
+    """Return True for errors a later attempt may get past: Google, network and credential failures.
+
+    Anything else, such as form data the sheet cannot take, fails the same
+    way on every attempt.
+    """
+    transient = [HttpError, OSError, CredentialsUnavailable]
+    if httplib2 is not None:
+        transient.append(httplib2.HttpLib2Error)
+    if asyncio is not None:
+        transient.append(asyncio.TimeoutError)
+    if _async_client is not None:
+        transient.extend(getattr(_async_client.transport, 'errors', ()))
+    return isinstance(err, tuple(transient))
+
+def _record_progress(job_id, sheet_id=None):
+    """Renew a job's lease as it moves on, and store its copied sheet once there is one."""
+    fields = {'not_before': time.time() + OUTBOX_LEASE}
+    if sheet_id is not None:
+        fields['sheet_id'] = sheet_id
+    update_outbox_entry(job_id, **fields)
+
+def _run_character_job(job_id, form_data, submission_key=None, sheet_id=None, attempts=0):
+    """Create (or finish creating) one character and settle its outbox entry.
+
+    A failed copy or failed cell writes leave the entry pending for a
+    retry with backoff; once the sheet exists, retries only write the
+    cells missing from its snapshot.
+    """
+    _update_job(job_id, status='running')
+    progress, outcome = _job_progress(job_id, _record_progress)
+    try:
+        if sheet_id is None:
+            sheet_id = process_request(form_data, progress=progress)
+        else:
+            outcome['failed_cells'] = _resume_character(sheet_id, form_data)
+    except Exception as err:
+        logger.exception("Error occurred in job %s: %s", job_id, err)
+        outcome['error'] = str(err)
+        outcome['retryable'] = _is_transient_job_error(err)
+    # A copy made before the error is kept, so the retry only writes its cells
+    sheet_id = sheet_id or outcome.get('sheet_id')
+    _settle_character_job(job_id, submission_key, sheet_id, attempts, outcome)
+
+async def _run_character_job_async(job_id, form_data, submission_key=None, sheet_id=None, attempts=0):
+    """_run_character_job on the asyncio transport; database work runs off the loop."""
+    loop = asyncio.get_running_loop()
+    _update_job(job_id, status='running')
+    progress, outcome = _job_progress(
+        job_id, lambda job_id, sheet_id: loop.run_in_executor(None, _record_progress, job_id, sheet_id))
+    try:
+        if sheet_id is None:
+            sheet_id = await process_request_async(form_data, progress=progress)
+        else:
+            outcome['failed_cells'] = await asyncio.to_thread(_resume_character, sheet_id, form_data)
+    except Exception as err:
+        logger.exception("Error occurred in job %s: %s", job_id, err)
+        outcome['error'] = str(err)
+        outcome['retryable'] = _is_transient_job_error(err)
+    sheet_id = sheet_id or outcome.get('sheet_id')
+    await asyncio.to_thread(_settle_character_job, job_id, submission_key, sheet_id, attempts, outcome)
+
+def _resume_character(sheet_id, form_data):
+    """Write whatever an already copied sheet is missing; return the failed cell count or None."""
+    result = update_existing_character(sheet_id, form_data, allow_full_write=True)
+    return len(result['failed_ranges']) if result is not None else None
+
+def _settle_character_job(job_id, submission_key, sheet_id, attempts, outcome):
+    """Mark an attempt done, schedule its retry or give up, and free its queue slot.
+
+    Errors that are not transient give up straight away.
+    """
+    global _active_jobs
+    complete = sheet_id is not None and outcome.get('failed_cells') == 0 and 'error' not in outcome
+    if 'error' in outcome:
+        error = outcome['error']
+    else:
+        error = 'Failed to copy the sheet.' if sheet_id is None else 'Failed to write some cells.'
+    try:
+        attempts += 1
+        if complete:
+            update_outbox_entry(job_id, status='done', sheet_id=sheet_id, attempts=attempts, error=None)
+            if submission_key is not None:
+                complete_submission(submission_key, sheet_id)
+            _update_job(job_id, status='done', sheet_id=sheet_id, error=None, attempts=attempts)
+        elif attempts < OUTBOX_MAX_ATTEMPTS and outcome.get('retryable', True):
+            delay = _outbox_retry_delay(attempts)
+            logger.warning("Job %s failed (attempt %s), retrying in %.0fs: %s", job_id, attempts, delay, error)
+            update_outbox_entry(job_id, status='pending', sheet_id=sheet_id, attempts=attempts, error=error,
+                                not_before=time.time() + delay)
+            _update_job(job_id, status='retrying', sheet_id=sheet_id, error=error, attempts=attempts)
+        else:
+            logger.error("Job %s failed for good after %s attempts: %s", job_id, attempts, error)
+            update_outbox_entry(job_id, status='failed', sheet_id=sheet_id, attempts=attempts, error=error)
+            if submission_key is not None:
+                release_submission(submission_key, job_id)
+            _update_job(job_id, status='failed', sheet_id=sheet_id, error=error, attempts=attempts)
+    finally:
+        with _jobs_lock:
+            _active_jobs -= 1
+        _outbox_wakeup.set()
+
+def drain_outbox():
+    """Start due outbox entries while the job queue has room, then compact finished ones.
+
+    Jobs renew their lease at each progress step, and those still queued
+    or running here are renewed on every pass as well, so one held up by
+    Google retries between two steps is not replayed under it.
+    """
+    with _jobs_lock:
+        room = JOB_QUEUE_LIMIT - _active_jobs
+        active = {job_id for job_id, job in _jobs.items() if job['status'] in ('queued', 'running')}
+    renew_outbox_leases(active)
+    if room > 0:
+        for entry in claim_outbox_entries(room):
+            if entry['job_id'] in active:
+                continue
+            try:
+                submit_character_job(json.loads(entry['form_data']), job_id=entry['job_id'],
+                                     submission_key=entry['submission_key'], sheet_id=entry['sheet_id'],
+                                     attempts=entry['attempts'])
+            except JobQueueFull:
+                update_outbox_entry(entry['job_id'], status='pending', not_before=time.time())
+    compact_outbox()
+
+def _outbox_drainer():
+    while True:
+        try:
+            drain_outbox()
+        except Exception as err:
+            logger.exception("Error draining the outbox: %s", err)
+        _outbox_wakeup.wait(OUTBOX_POLL_INTERVAL)
+        _outbox_wakeup.clear()
+
+# Picks up characters left over from a previous run as well as queue overflow;
+# `python serve.py authorize` only writes a token and must not start any
+if sys.argv[1:2] != ['authorize']:
+    threading.Thread(target=_outbox_drainer, name='outbox-drainer', daemon=True).start()
+
+def get_job(job_id):
+    """Return a snapshot of a job's state, or None if it is unknown.
+
+    Jobs run by another worker process, waiting in the outbox or already
+    forgotten here are looked up in the database.
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            return dict(job)
+    entry = get_outbox_entry(job_id)
+    if entry is not None:
+        status = entry['status']
+        if status == 'pending':
+            status = 'retrying' if entry['attempts'] else 'queued'
+        return {
+            'job_id': job_id,
+            'status': status,
+            'stage': status,
+            'character_name': json.loads(entry['form_data']).get('character_name'),
+            'sheet_id': entry['sheet_id'],
+            'error': entry['error'],
+            'attempts': entry['attempts'],
+            'submitted_at': entry['created_at'],
+        }
+    submission = find_submission_by_job(job_id)
+    if submission is None:
+        return None
+    return {
+        'job_id': job_id,
+        'status': 'done' if submission['status'] == 'done' else 'running',
+        'stage': 'done' if submission['status'] == 'done' else 'running',
+        'character_name': submission['character_name'],
+        'sheet_id': submission['sheet_id'],
+        'error': None,
+        'submitted_at': submission['created_at'],
+    }
+
+def wait_for_job(job_id, timeout=None, poll_interval=0.25):
+    """Block until a job has finished, failed or been put off for a retry, or timeout passes.
+
+    Jobs of this process are waited on directly; jobs of another worker
+    process (or not yet started here) are polled through the database.
+    """
+    def settled(job):
+        return job is None or job['status'] not in ('queued', 'running')
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        with _jobs_changed:
+            if job_id in _jobs:
+                _jobs_changed.wait_for(lambda: settled(_jobs.get(job_id)),
+                                       None if deadline is None else max(0, deadline - time.monotonic()))
+                job = _jobs.get(job_id)
+                if job is not None:
+                    return dict(job)
+        job = get_job(job_id)
+        if settled(job):
+            return job
+        if deadline is not None and time.monotonic() >= deadline:
+            return job
+        time.sleep(poll_interval)
+
+@app.route('/jobs/<string:job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
+
+def _sse_event(event_id, stage, job):
+    return f"id: {event_id}\nevent: {stage}\ndata: {json.dumps(job, separators=(',', ':'))}\n\n"
+
+def job_event_stream(job_id, start=0):
+    """Yield a job's progress as Server-Sent Events, from event number start.
+
+    Each event is named after the stage reached and carries the job's state
+    at that point. The stream ends after 'done' or 'failed', and after
+    'retrying' too, since the retry may be hours away: the client polls
+    /jobs/<job_id> from there rather than holding a thread or worker.
+    """
+    sent = start
+    while True:
+        with _jobs_changed:
+            _jobs_changed.wait_for(lambda: len(_job_events.get(job_id, ())) > sent or job_id not in _job_events,
+                                   timeout=SSE_KEEPALIVE)
+            events = _job_events.get(job_id)
+            new_events = list(events[sent:]) if events is not None else None
+        if new_events is None:
+            # Forgotten from the history; the last known state is in get_job
+            job = get_job(job_id)
+            if job is not None:
+                yield _sse_event(sent, job['status'], job)
+            return
+        if not new_events:
+            yield ': keep-alive\n\n'
+            continue
+        for stage, job in new_events:
+            yield _sse_event(sent, stage, job)
+            sent += 1
+            if stage in ('done', 'failed', 'retrying'):
+                return
+
+def _remote_job_event_stream(job_id):
+    """Progress of a job run by another worker process, which only knows its status.
+
+    While the job is queued or running, its status is polled through the
+    database and a keep-alive sent every SSE_KEEPALIVE. Like
+    job_event_stream, the stream ends once the job is done, failed or
+    waiting for a retry.
+    """
+    job = get_job(job_id)
+    sent = 0
+    yield _sse_event(sent, job['status'], job)
+    while job is not None and job['status'] not in ('done', 'failed', 'retrying'):
+        status = job['status']
+        job = wait_for_job(job_id, timeout=SSE_KEEPALIVE)
+        if job is None:
+            sent += 1
+            yield _sse_event(sent, 'failed', {'job_id': job_id, 'status': 'failed',
+                                              'error': 'Character creation failed, please retry.'})
+        elif job['status'] != status:
+            sent += 1
+            yield _sse_event(sent, job['status'], job)
+        else:
+            yield ': keep-alive\n\n'
+
+@app.route('/jobs/<string:job_id>/events', methods=['GET'])
+def job_events(job_id):
+    with _jobs_lock:
+        local = job_id in _job_events
+    if local:
+        try:
+            start = int(request.headers.get('Last-Event-ID', -1)) + 1
+        except ValueError:
+            start = 0
+        stream = job_event_stream(job_id, start)
+    elif get_job(job_id) is not None:
+        stream = _remote_job_event_stream(job_id)
+    else:
+        return jsonify({'error': 'Unknown job'}), 404
+    response = Response(stream, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop proxies such as nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+_bulk_executor = ThreadPoolExecutor(max_workers=BULK_WORKERS, thread_name_prefix='bulk-import')
+
+def parse_csv_characters(text):
+    """Turn CSV rows into character payloads shaped like the form submission.
+
+    Expected columns are character_name, class, level, subclass, the six
+    ability scores, spells ("1: Shield; 2: Misty Step") and multiclass
+    ("Fighter:2:Champion; Rogue:1").
+    """
+    characters = []
+    for row in csv.DictReader(io.StringIO(text)):
+        row = {key.strip(): (value or '').strip() for key, value in row.items() if key}
+        class_data = []
+        if row.get('class'):
+            primary = {'class': row['class'], 'level': row.get('level', '1')}
+            if row.get('subclass'):
+                primary['subclass'] = row['subclass']
+            class_data.append(primary)
+        for entry in filter(None, (part.strip() for part in row.get('multiclass', '').split(';'))):
+            parts = [part.strip() for part in entry.split(':')]
+            multiclass = {'class': parts[0], 'level': parts[1] if len(parts) > 1 else '1'}
+            if len(parts) > 2 and parts[2]:
+                multiclass['subclass'] = parts[2]
+            class_data.append(multiclass)
+        form_data = {
+            'character_name': row.get('character_name'),
+            'class_data': class_data,
+            'spells': [spell.strip() for spell in row.get('spells', '').split(';') if spell.strip()],
+        }
+        for ability in ('strength', 'dexterity', 'constitution', 'intelligence', 'wisdom', 'charisma'):
+            form_data[ability] = row.get(ability)
+        characters.append(form_data)
+    return characters
+
+def parse_jsonl_characters(text):
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def parse_bulk_request():
+    """Extract the list of character payloads from a JSON, CSV or JSONL bulk request."""
+    upload = request.files.get('file')
+    if upload is not None:
+        text = upload.read().decode('utf-8-sig')
+        filename = (upload.filename or '').lower()
+        if filename.endswith('.csv') or upload.mimetype == 'text/csv':
+            return parse_csv_characters(text)
+        return parse_jsonl_characters(text)
+
+    if request.mimetype == 'text/csv':
+        return parse_csv_characters(request.get_data(as_text=True))
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        return parse_jsonl_characters(request.get_data(as_text=True))
+
+    data = request.get_json()
+    if isinstance(data, dict):
+        data = data.get('characters')
+    return data
+
+@app.route('/update/<string:sheet_id>', methods=['POST'])
+def update_character(sheet_id):
+    """Apply new form data to an existing character sheet, writing only changed cells."""
+    form_data = request.get_json(silent=True)
+    invalid = find_invalid_character(form_data)
+    if invalid:
+        return jsonify({'error': invalid}), 400
+    try:
+        result = update_existing_character(sheet_id, form_data)
+    except UnknownSheet as err:
+        return jsonify({'error': str(err)}), 404
+    except Exception as err:
+        logger.exception("Error updating %s: %s", sheet_id, err)
+        return jsonify({'error': str(err)}), 500
+    if result is None:
+        return jsonify({'error': 'Could not reach the character sheet'}), 502
+    return jsonify(result), 500 if result['failed_ranges'] else 200
+
+@app.route('/bulk', methods=['POST'])
+def bulk_import():
+    """Create many characters concurrently, streaming one JSON line per finished character."""
+    try:
+        characters = parse_bulk_request()
+    except (ValueError, UnicodeDecodeError) as err:
+        return jsonify({'error': f'Could not parse characters: {err}'}), 400
+    if not isinstance(characters, list) or not all(isinstance(entry, dict) for entry in characters):
+        return jsonify({'error': 'Invalid input. Expected a list of character objects.'}), 400
+    if len(characters) > BULK_MAX_CHARACTERS:
+        return jsonify({'error': f'At most {BULK_MAX_CHARACTERS} characters can be imported at once.'}), 413
+
+    futures = {_bulk_executor.submit(process_request, form_data): index
+               for index, form_data in enumerate(characters)}
+
+    def generate():
+        try:
+            for future in as_completed(futures):
+                index = futures[future]
+                result = {'index': index, 'character_name': characters[index].get('character_name')}
+                try:
+                    new_sheet_id = future.result()
+                    if new_sheet_id:
+                        result['sheet_id'] = new_sheet_id
+                    else:
+                        result['error'] = 'Failed to copy the sheet.'
+                except Exception as err:
+                    result['error'] = str(err)
+                yield json.dumps(result) + '\n'
+        finally:
+            # Stop characters that have not started yet if the client goes away
+            for future in futures:
+                future.cancel()
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+def find_invalid_character(form_data):
+    """Return why a character payload cannot be written to a sheet, or None if it can.
+
+    Checked before a character is queued, since no retry can fix bad input.
+    """
+    if not isinstance(form_data, dict):
+        return 'Expected the character as a JSON object'
+    for ability in ABILITY_NAMES:
+        value = form_data.get(ability)
+        try:
+            if isinstance(value, bool) or value is None:
+                raise TypeError
+            int(value)
+        except (TypeError, ValueError):
+            return f'Invalid input. {ability} must be a whole number.'
+    class_data = form_data.get('class_data', [])
+    if not isinstance(class_data, list) or not all(isinstance(entry, dict) for entry in class_data):
+        return 'Invalid input. class_data must be a list of objects.'
+    for field in ('spells', 'features'):
+        if not isinstance(form_data.get(field, []), list):
+            return f'Invalid input. {field} must be a list.'
+    return None
+
+def _job_response(job):
+    """Respond with a finished job's sheet, or with its job ID while it is still running."""
+    if job is None:
+        # Failed in another worker process, which forgot the submission
+        return jsonify({'error': 'Character creation failed, please retry.'}), 500
+    if job['status'] == 'done':
+        return jsonify({'character_name': job['character_name'], 'sheet_id': job['sheet_id'],
+                        'job_id': job['job_id'], 'unplaced_spells': job.get('unplaced_spells', [])})
+    if job['status'] == 'failed':
+        return jsonify({'error': job['error'], 'job_id': job['job_id']}), 500
+    # Still queued, running or waiting for a retry: the outbox will finish it
+    response = jsonify({'character_name': job['character_name'], 'job_id': job['job_id'],
+                        'status': job['status']})
+    response.headers['Location'] = f"/jobs/{job['job_id']}"
+    return response, 202
+
+@app.route('/', methods=['GET', 'POST'])
+def index():
+    if request.method == 'POST':
+        try:
+            form_data = request.get_json(silent=True)
+            logger.debug("Received form data: %s", form_data)
+            invalid = find_invalid_character(form_data)
+            if invalid:
+                return jsonify({'error': invalid}), 400
+            wait = not request.args.get('async')
+            key = request.headers.get('Idempotency-Key') or submission_key(form_data)
+            job_id = uuid.uuid4().hex
+
+            existing = claim_submission(key, job_id, form_data)
+            if existing is not None:
+                # Repeated submission: reuse the sheet or attach to the job creating it
+                logger.info("Duplicate submission of %s attached to job %s", key, existing['job_id'])
+                job_id = existing['job_id']
+            else:
+                try:
+                    submit_character_job(form_data, job_id=job_id, submission_key=key)
+                except JobQueueFull:
+                    # Already safe in the outbox; the drainer starts it when there is room
+                    update_outbox_entry(job_id, status='pending', not_before=time.time())
+                    wait = False
+
+            job = wait_for_job(job_id, timeout=IDEMPOTENCY_PENDING_TIMEOUT) if wait else get_job(job_id)
+            return _job_response(job)
+        except Exception as e:
+            logger.exception("Error occurred: %s", e)
+            return jsonify({'error': str(e)}), 500
+    else:
+        return index_page()
+
+@app.route('/result')
+def result():
+    sheet_id = request.args.get('sheet_id')
+    character_name = request.args.get('character_name')
+    unplaced_spells = request.args.getlist('unplaced_spell')
+    return render_template('result.html', sheet_id=sheet_id, character_name=character_name,
+                           unplaced_spells=unplaced_spells)
+
+@app.errorhandler(Exception)
+def handle_error(error):
+    """Global error handler."""
+    logger.error("Error occurred: %s", error)
+    return index_page()
+
+def main(argv):
+    """Store a Google token with `authorize`, otherwise serve the app; see serve.py."""
+    if argv[:1] == ['authorize']:
+        credential_store.authorize()
+        logger.info("Saved a new Google token to %s", TOKEN_FILE)
+    elif os.environ.get('GSHEET_SERVER') == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        port = int(os.environ.get('GSHEET_PORT', '5000'))
+        logger.info("Serving on port %s with gevent", port)
+        WSGIServer(('', port), app).serve_forever()
+    else:
+        app.run(debug=True)
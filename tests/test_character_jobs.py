@@ -0,0 +1,94 @@
+"""Background character jobs against the in-process fake Google API."""
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from fake_google import FakeGoogleApi
+from site_loader import load_site
+
+site = load_site(lift_quotas=True, scratch_db=True)
+
+CHARACTER = {
+    'character_name': 'Tester',
+    'class_data': [{'class': 'Wizard', 'level': '3'}],
+    'spells': ['1: Shield'],
+    'strength': '8', 'dexterity': '14', 'constitution': '14',
+    'intelligence': '15', 'wisdom': '12', 'charisma': '8',
+}
+
+
+class CharacterJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeGoogleApi(template_id=site.TEMPLATE_SPREADSHEET_ID)
+        site.google_http_factory = self.fake.http
+        site.async_transport_factory = self.fake.async_transport
+        site._async_client = None
+        self.addCleanup(setattr, site, 'ASYNC_GOOGLE', site.ASYNC_GOOGLE)
+
+    def run_job(self, form_data):
+        """Start a job the way POST / does and wait until it has finished or been put off."""
+        return site.wait_for_job(self.start_job(form_data), timeout=10)
+
+    def start_job(self, form_data):
+        job_id = uuid.uuid4().hex
+        key = uuid.uuid4().hex
+        self.assertIsNone(site.claim_submission(key, job_id, form_data))
+        site.submit_character_job(form_data, job_id=job_id, submission_key=key)
+        return job_id
+
+    def assert_copy_kept_after_error(self):
+        # Raises once the sheet has been copied, when the cells are planned
+        job = self.run_job(dict(CHARACTER, strength=''))
+        self.assertEqual(self.fake.calls['drive.files.copy'], 1)
+        # Bad input fails the same way every time, so it is not retried
+        self.assertEqual((job['status'], job['attempts']), ('failed', 1))
+        self.assertIsNotNone(job['sheet_id'])
+        self.assertEqual(site.get_outbox_entry(job['job_id'])['sheet_id'], job['sheet_id'])
+
+    def test_failed_write_keeps_the_copied_sheet(self):
+        site.ASYNC_GOOGLE = False
+        self.assert_copy_kept_after_error()
+
+    def test_failed_write_keeps_the_copied_sheet_async(self):
+        site.ASYNC_GOOGLE = True
+        self.assert_copy_kept_after_error()
+
+    def test_slow_job_is_not_replayed_while_it_runs(self):
+        site.ASYNC_GOOGLE = False
+        self.fake.latency = 0.5
+        with mock.patch.object(site, 'OUTBOX_LEASE', 0.1):
+            job_id = self.start_job(CHARACTER)
+            # Past the lease, while the job is still copying the template
+            time.sleep(0.2)
+            site.drain_outbox()
+            job = site.wait_for_job(job_id, timeout=10)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(self.fake.calls['drive.files.copy'], 1)
+
+    def test_spells_without_a_cell_are_reported(self):
+        site.ASYNC_GOOGLE = False
+        job = self.run_job(dict(CHARACTER, spells=['1: Shield', '3: Fireball', '0: Fire Bolt']))
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['unplaced_spells'], ['3: Fireball', '0: Fire Bolt'])
+        written = [event for stage, event in site._job_events[job['job_id']] if stage == 'written']
+        self.assertEqual(written[0]['unplaced_spells'], ['3: Fireball', '0: Fire Bolt'])
+        self.assertNotIn([['Fireball']], list(self.fake.files[job['sheet_id']]['values'].values()))
+
+    def test_invalid_character_is_rejected_before_queueing(self):
+        client = site.app.test_client()
+        for form_data in (dict(CHARACTER, strength=''), dict(CHARACTER, class_data='Wizard 3'),
+                          dict(CHARACTER, class_data=['Wizard'])):
+            response = client.post('/?async=1', json=form_data)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.json)
+        self.assertEqual(self.fake.total_calls, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
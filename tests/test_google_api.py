@@ -0,0 +1,56 @@
+"""The Google API scheduler: quota shares and retries."""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from site_loader import load_site
+
+site = load_site(lift_quotas=True, scratch_db=True)
+
+
+class DroppedConnectionRequest:
+    """A googleapiclient request whose connection is reset on every attempt."""
+
+    body = None
+
+    def __init__(self):
+        self.attempts = 0
+
+    def execute(self):
+        self.attempts += 1
+        raise ConnectionResetError('Connection reset by peer')
+
+
+class GoogleApiSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        # Requests are built by get_google_service, which loads these first
+        site.load_google_clients()
+        for name, value in (('GOOGLE_API_MAX_RETRIES', 2), ('_backoff_delay', lambda err, attempt: 0)):
+            patcher = mock.patch.object(site, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_dropped_connection_is_retried_for_idempotent_calls(self):
+        request = DroppedConnectionRequest()
+        with self.assertRaises(ConnectionResetError):
+            site.execute_google_request(request, 'sheets')
+        self.assertEqual(request.attempts, 3)
+
+    def test_dropped_connection_is_not_retried_for_a_copy(self):
+        request = DroppedConnectionRequest()
+        with self.assertRaises(ConnectionResetError):
+            site.execute_google_request(request, 'drive', idempotent=False)
+        self.assertEqual(request.attempts, 1)
+
+    def test_quota_is_split_between_worker_processes(self):
+        with mock.patch.object(site, 'GOOGLE_API_PROCESSES', 4):
+            self.assertEqual(site._process_budget(60), 15)
+            self.assertEqual(site._process_budget(2), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
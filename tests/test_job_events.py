@@ -0,0 +1,87 @@
+"""Progress streams of character jobs."""
+import json
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from site_loader import load_site
+
+site = load_site(scratch_db=True)
+
+
+class FakeClock:
+    """Stands in for site.py's time module: sleeping only moves the monotonic clock on."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def time(self):
+        return time.time()
+
+
+class RemoteJobEventStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        keepalive = mock.patch.object(site, 'SSE_KEEPALIVE', 1.0)
+        keepalive.start()
+        self.addCleanup(keepalive.stop)
+
+    def add_remote_job(self, job_id, attempts=0):
+        """An outbox entry another worker holds: queued, or put off for a retry with attempts."""
+        now = time.time()
+        site.get_db().execute(
+            'INSERT INTO outbox (job_id, submission_key, form_data, status, attempts, not_before, created_at, '
+            'updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (job_id, None, json.dumps({'character_name': 'Remote'}), 'pending', attempts, now + 3600, now, now))
+
+    def test_waiting_job_yields_one_keep_alive_per_interval(self):
+        self.add_remote_job('queued-job')
+        clock = FakeClock()
+        with mock.patch.object(site, 'time', clock):
+            stream = site._remote_job_event_stream('queued-job')
+            self.assertIn('event: queued', next(stream))
+            chunks = []
+            while clock.now < 10 and len(chunks) < 20:
+                chunks.append(next(stream))
+        self.assertEqual(chunks, [': keep-alive\n\n'] * 10)
+
+    def test_stream_ends_when_job_finishes(self):
+        self.add_remote_job('finished-job')
+        stream = site._remote_job_event_stream('finished-job')
+        next(stream)
+        site.update_outbox_entry('finished-job', status='done', sheet_id='sheet')
+        self.assertIn('event: done', next(stream))
+        self.assertEqual(list(stream), [])
+
+    def test_stream_ends_while_job_waits_for_retry(self):
+        self.add_remote_job('retrying-job', attempts=1)
+        chunks = list(site._remote_job_event_stream('retrying-job'))
+        self.assertEqual(len(chunks), 1)
+        self.assertIn('event: retrying', chunks[0])
+
+
+class JobEventStreamTest(unittest.TestCase):
+
+    def test_stream_ends_while_job_waits_for_retry(self):
+        job = {'job_id': 'local-job', 'status': 'running', 'stage': 'running'}
+        with site._jobs_changed:
+            site._jobs['local-job'] = job
+            site._job_events['local-job'] = [('running', dict(job))]
+        stream = site.job_event_stream('local-job')
+        self.assertIn('event: running', next(stream))
+        site._update_job('local-job', status='retrying', error='Google is down')
+        self.assertIn('event: retrying', next(stream))
+        self.assertEqual(list(stream), [])
+
+if __name__ == '__main__':
+    unittest.main()
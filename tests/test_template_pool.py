@@ -0,0 +1,54 @@
+"""The pool of blank template copies shared through the database."""
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from fake_google import FakeGoogleApi
+from site_loader import load_site
+
+site = load_site(lift_quotas=True, scratch_db=True)
+
+
+class TemplatePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeGoogleApi(template_id=site.TEMPLATE_SPREADSHEET_ID)
+        site.google_http_factory = self.fake.http
+        site._template_layouts.clear()
+        for name, value in (('TEMPLATE_POOL_SIZE', 2), ('TEMPLATE_POOL_LOW_WATER', 1)):
+            patcher = mock.patch.object(site, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def refill(self):
+        site.refill_template_pool()
+        deadline = time.monotonic() + 10
+        while site._template_pool_refilling and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def pooled_copies(self):
+        return dict(site.get_db().execute('SELECT sheet_id, template_version FROM template_pool').fetchall())
+
+    def test_copies_of_an_edited_template_are_trashed_not_handed_out(self):
+        self.refill()
+        old_copies = self.pooled_copies()
+        self.assertEqual(set(old_copies.values()), {'1'})
+
+        # Edited in Drive; the cached layout is re-checked after its TTL
+        self.fake.files[site.TEMPLATE_SPREADSHEET_ID]['version'] += 1
+        site._template_layouts.clear()
+        sheet_id = site.claim_template_copy('Hero')
+        self.assertNotIn(sheet_id, old_copies)
+
+        self.refill()
+        self.assertEqual(set(self.pooled_copies().values()), {'2'})
+        for old_sheet_id in old_copies:
+            self.assertTrue(self.fake.files[old_sheet_id].get('trashed'))
+
+
+if __name__ == '__main__':
+    unittest.main()